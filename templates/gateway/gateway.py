@@ -1,9 +1,17 @@
+import functools
+
+import gevent
+from gevent.event import AsyncResult
+from gevent.lock import BoundedSemaphore
 from js9 import j
 from zerorobot.template.base import TemplateBase
 from zerorobot.template.state import StateCheckError
 
 NODE_CLIENT = 'local'
-
+RECONFIGURE_DELAY = 1  # seconds during which queued changes are gathered into one reconfiguration
+QUEUED_CHANGES_TIMEOUT = 120  # seconds queue_changes waits for its changes to be applied
+CHANGE_ACTIONS = ('add_portforward', 'remove_portforward', 'add_http_proxy', 'remove_http_proxy',
+                  'add_dhcp_host', 'remove_dhcp_host')
 
 class Gateway(TemplateBase):
     version = '0.0.1'
@@ -13,6 +21,11 @@ class Gateway(TemplateBase):
         super().__init__(name=name, guid=guid, data=data)
         self.recurring_action('_monitor', 30)
         self.add_delete_callback(self.uninstall)
+        self._gateway_sal_cache = (None, None)  # (node client, gateway sal), reset by _data_changed
+        self._indexes_cache = None  # (indexed lists, indexes), see _indexes
+        self._configure_lock = BoundedSemaphore()
+        self._deferred = None  # queued changes waiting for their reconfiguration, see _reset_deferred
+        self._reset_deferred()
 
     def validate(self):
         if not self.data['hostname']:
@@ -41,208 +54,508 @@ class Gateway(TemplateBase):
 
     @property
     def _gateway_sal(self):
-        gw = self._node_sal.primitives.from_dict('gateway', self.data)
-        gw.name = self.guid
+        """
+        gateway sal, only rebuilt when js9 gives another client for the node or the service data was changed
+        """
+        node_sal = self._node_sal
+        cached_client, gw = self._gateway_sal_cache
+        if cached_client is not node_sal.client:
+            gw = node_sal.primitives.from_dict('gateway', self.data)
+            gw.name = self.guid
+            self._gateway_sal_cache = (node_sal.client, gw)
         return gw
 
+    def _data_changed(self):
+        """
+        Must be called after changing the service data, so the gateway sal is rebuilt from it
+        """
+        self._gateway_sal_cache = (None, None)
+
+    def update_data(self, data):
+        super().update_data(data)
+        self._data_changed()
+
     def install(self):
         self.logger.info('Install gateway {}'.format(self.name))
-        gateway_sal = self._gateway_sal
-        gateway_sal.deploy()
-        self.data['ztIdentity'] = gateway_sal.zt_identity
+        with self._configure_lock:
+            self._flush_deferred()
+            gateway_sal = self._gateway_sal
+            gateway_sal.deploy()
+            self.data['ztIdentity'] = gateway_sal.zt_identity
+            self._data_changed()
         self.state.set('actions', 'install', 'ok')
         self.state.set('actions', 'start', 'ok')
         self.state.set('state', 'running', 'ok')
 
     def add_portforward(self, forward):
+        """
+        Add a port forward
+        :param forward: port forward to add
+        """
         self.logger.info('Add portforward {}'.format(forward['name']))
         self.state.check('actions', 'start', 'ok')
-
-        for network in self.data['networks']:
-            if network['name'] == forward['srcnetwork']:
-                break
-        else:
-            raise LookupError('Network with name {} doesn\'t exist'.format(forward['srcnetwork']))
-
-        for fw in self.data['portforwards']:
-            name, combination = self._compare_objects(fw, forward, 'srcnetwork', 'srcport')
-            if name:
-                raise ValueError('A forward with the same name exists')
-            if combination:
-                if set(fw['protocols']).intersection(set(forward['protocols'])):
-                    raise ValueError('Forward conflicts with existing forward')
-        self.data['portforwards'].append(forward)
-
-        try:
-            self._gateway_sal.configure_fw()
-        except:
-            self.logger.error('Failed to add portforward, restoring gateway to previous state')
-            self.data['portforwards'].remove(forward)
-            self._gateway_sal.configure_fw()
-            raise
+        self._apply_changes([{'action': 'add_portforward', 'args': {'forward': forward}}])
 
     def remove_portforward(self, name):
+        """
+        Remove a port forward
+        :param name: name of the port forward to remove
+        """
         self.logger.info('Remove portforward {}'.format(name))
         self.state.check('actions', 'start', 'ok')
-
-        for fw in self.data['portforwards']:
-            if fw['name'] == name:
-                self.data['portforwards'].remove(fw)
-                break
-        else:
-            return
-
-        try:
-            self._gateway_sal.configure_fw()
-        except:
-            self.logger.error('Failed to remove portforward, restoring gateway to previous state')
-            self.data['portforwards'].append(fw)
-            self._gateway_sal.configure_fw()
-            raise
+        self._apply_changes([{'action': 'remove_portforward', 'args': {'name': name}}])
 
     def add_http_proxy(self, proxy):
+        """
+        Add an http proxy
+        :param proxy: http proxy to add
+        """
         self.logger.info('Add http proxy {}'.format(proxy['name']))
         self.state.check('actions', 'start', 'ok')
-
-        for existing_proxy in self.data['httpproxies']:
-            name, combination = self._compare_objects(existing_proxy, proxy, 'host')
-            if name:
-                raise ValueError('A proxy with the same name exists')
-            if combination:
-                raise ValueError("Proxy with host {} already exists".format(proxy['host']))
-        self.data['httpproxies'].append(proxy)
-
-        try:
-            self._gateway_sal.configure_http()
-        except:
-            self.logger.error('Failed to add http proxy, restoring gateway to previous state')
-            self.data['httpproxies'].remove(proxy)
-            self._gateway_sal.configure_http()
-            raise
+        self._apply_changes([{'action': 'add_http_proxy', 'args': {'proxy': proxy}}])
 
     def remove_http_proxy(self, name):
+        """
+        Remove an http proxy
+        :param name: name of the http proxy to remove
+        """
         self.logger.info('Remove http proxy {}'.format(name))
         self.state.check('actions', 'start', 'ok')
-
-        for existing_proxy in self.data['httpproxies']:
-            if existing_proxy['name'] == name:
-                self.data['httpproxies'].remove(existing_proxy)
-                break
-        else:
-            return
-        try:
-            self._gateway_sal.configure_http()
-        except:
-            self.logger.error('Failed to remove http proxy, restoring gateway to previous state')
-            self.data['httpproxies'].append(existing_proxy)
-            self._gateway_sal.configure_http()
-            raise
+        self._apply_changes([{'action': 'remove_http_proxy', 'args': {'name': name}}])
 
     def add_dhcp_host(self, network_name, host):
+        """
+        Add a host to the dhcp server of a network
+        :param network_name: name of the network
+        :param host: host to add
+        """
         self.logger.info('Add dhcp to network {}'.format(network_name))
         self.state.check('actions', 'start', 'ok')
+        self._apply_changes([{'action': 'add_dhcp_host', 'args': {'network_name': network_name, 'host': host}}])
 
-        for network in self.data['networks']:
-            if network['name'] == network_name:
-                break
-        else:
-            raise LookupError('Network with name {} doesn\'t exist'.format(network_name))
-        dhcpserver = network['dhcpserver']
-        for existing_host in dhcpserver['hosts']:
-            if existing_host['macaddress'] == host['macaddress']:
-                raise ValueError('Host with macaddress {} already exists'.format(host['macaddress']))
-        dhcpserver['hosts'].append(host)
+    def remove_dhcp_host(self, network_name, host):
+        """
+        Remove a host from the dhcp server of a network
+        :param network_name: name of the network
+        :param host: host to remove
+        """
+        self.logger.info('Add dhcp to network {}'.format(network_name))
+        self.state.check('actions', 'start', 'ok')
+        self._apply_changes([{'action': 'remove_dhcp_host', 'args': {'network_name': network_name, 'host': host}}])
+
+    def apply_changes(self, changes, atomic=True):
+        """
+        Apply a batch of changes to the port forwards, http proxies and dhcp hosts of the gateway.
+        The firewall, the http proxy and the dhcp server are reconfigured at most once for the whole batch
+        :param changes: list of {'action': name of the action doing the change, 'args': arguments of the action}
+                        the supported actions are add_portforward, remove_portforward, add_http_proxy,
+                        remove_http_proxy, add_dhcp_host and remove_dhcp_host
+        :param atomic: if True, either all the changes are applied or none of them and the error is raised.
+                       If False, each change is applied unless it is not valid
+        :return: if not atomic, list of {'action': action, 'error': error} in the same order as changes,
+                 error is None if the change was applied
+        """
+        self.logger.info('Apply {} changes'.format(len(changes)))
+        self.state.check('actions', 'start', 'ok')
+        if atomic:
+            self._apply_changes(changes)
+            return
 
+        with self._configure_lock:
+            self._flush_deferred()
+            configs, undos, errors = self._change_batches([[change] for change in changes])
+            try:
+                self._configure(configs)
+            except Exception as err:
+                self.logger.error('Failed to apply changes, restoring gateway to previous state')
+                self._restore(configs, undos)
+                errors = [error or err for error in errors]
+        return [{'action': change['action'], 'error': str(error) if error else None}
+                for change, error in zip(changes, errors)]
+
+    def queue_changes(self, changes):
+        """
+        Apply a batch of changes together with the batches queued by other callers in the next RECONFIGURE_DELAY
+        seconds: the parts of the gateway are reconfigured once for all of them, but each caller gets the outcome
+        of its own batch. Either all the changes of the batch are applied or none of them, and the error is raised.
+        This is meant to be called directly by the services of this robot, not scheduled as an action:
+        the actions of the gateway run one after the other so they can't be gathered
+        :param changes: list of changes, see apply_changes
+        :raises TimeoutError: if the batch was still waiting in the queue after QUEUED_CHANGES_TIMEOUT seconds,
+                              it is then dropped. Once taken from the queue, the batch is waited for until
+                              the reconfiguration applying it ends, so a caller never sees a timeout for changes
+                              that get applied anyway
+        """
+        self.state.check('actions', 'start', 'ok')
+        result = AsyncResult()
+        queued = (changes, result)
+        self._deferred['queue'].append(queued)
+        self._schedule_deferred()
+        if not result.wait(QUEUED_CHANGES_TIMEOUT) and queued in self._deferred['queue']:
+            self._deferred['queue'].remove(queued)
+            raise TimeoutError('Gateway {} did not apply the changes within {} seconds'.format(
+                self.name, QUEUED_CHANGES_TIMEOUT))
+        # _flush_deferred resolves the results of all the batches it took
+        return result.get()
+
+    def _apply_changes(self, changes):
+        """
+        Change the service data, then reconfigure each part of the gateway affected by the changes.
+        If a change is not valid or the gateway fails to be reconfigured,
+        the service data and the gateway are restored to their previous state.
+        The queued changes are applied first, so the changes are applied in the order they were requested
+        """
+        with self._configure_lock:
+            self._flush_deferred()
+            configs, undos = self._change(changes)
+            try:
+                self._configure(configs)
+            except:
+                self.logger.error('Failed to apply changes, restoring gateway to previous state')
+                self._restore(configs, undos)
+                raise
+
+    def _change(self, changes):
+        """
+        Validate changes and apply them to the service data, either all of them or none
+        :return: the parts of the gateway to reconfigure and the functions undoing the changes
+        """
+        configs = set()
+        undos = []
         try:
-            self._gateway_sal.configure_dhcp()
-            self._gateway_sal.configure_cloudinit()
+            for change in changes:
+                if change['action'] not in CHANGE_ACTIONS:
+                    raise ValueError('Action {} is not a supported change'.format(change['action']))
+                config, undo = getattr(self, '_' + change['action'])(**change.get('args', {}))
+                if config:
+                    configs.add(config)
+                    undos.append(undo)
         except:
-            self.logger.error('Failed to add dhcp host, restoring gateway to previous state')
-            dhcpserver['hosts'].remove(host)
-            self._gateway_sal.configure_dhcp()
-            self._gateway_sal.configure_cloudinit()
+            self._undo_changes(undos)
             raise
+        return configs, undos
 
-    def remove_dhcp_host(self, network_name, host):
-        self.logger.info('Add dhcp to network {}'.format(network_name))
+    def _change_batches(self, batches):
+        """
+        Validate batches of changes and apply them to the service data, each batch entirely or not at all
+        :return: the parts of the gateway to reconfigure, the functions undoing the applied batches
+                 and the error of each batch, None if it was applied
+        """
+        configs = set()
+        undos = []
+        errors = []
+        for changes in batches:
+            try:
+                batch_configs, batch_undos = self._change(changes)
+            except Exception as err:
+                errors.append(err)
+                continue
+            configs.update(batch_configs)
+            undos.extend(batch_undos)
+            errors.append(None)
+        return configs, undos, errors
+
+    def _schedule_deferred(self):
+        """
+        Reconfigure the gateway for the queued changes in RECONFIGURE_DELAY seconds
+        """
+        if self._deferred['greenlet'] is None:
+            self._deferred['greenlet'] = gevent.spawn_later(RECONFIGURE_DELAY, self._configure_deferred)
 
-        self.state.check('actions', 'start', 'ok')
+    def _configure_deferred(self):
+        """
+        Apply the queued changes, then reconfigure the parts of the gateway affected by them.
+        If the gateway fails to be reconfigured, all these changes are undone
+        """
+        with self._configure_lock:
+            self._flush_deferred()
 
-        for network in self.data['networks']:
-            if network['name'] == network_name:
-                break
-        else:
-            raise LookupError('Network with name {} doesn\'t exist'.format(network_name))
-        dhcpserver = network['dhcpserver']
-        for existing_host in dhcpserver['hosts']:
-            if existing_host['macaddress'] == host['macaddress']:
-                dhcpserver['hosts'].remove(existing_host)
-                break
-        else:
-            raise LookupError('Host with macaddress {} doesn\'t exist'.format(host['macaddress']))
+    def _flush_deferred(self):
+        """
+        Apply the queued changes now, see _configure_deferred.
+        Must be called with the configure lock held
+        """
+        deferred = self._reset_deferred()
+        greenlet = deferred['greenlet']
+        if greenlet is not None and greenlet is not gevent.getcurrent():
+            greenlet.kill(block=False)
+        if not deferred['queue']:
+            return
 
         try:
-            self._gateway_sal.configure_dhcp()
-            self._gateway_sal.configure_cloudinit()
-        except:
-            self.logger.error('Failed to remove dhcp, restoring gateway to previous state')
-            dhcpserver['hosts'].append(existing_host)
-            self._gateway_sal.configure_dhcp()
-            self._gateway_sal.configure_cloudinit()
-            raise
+            configs, undos, errors = self._change_batches([changes for changes, _ in deferred['queue']])
+            results = []
+            for (_, result), error in zip(deferred['queue'], errors):
+                if error:
+                    result.set_exception(error)
+                else:
+                    results.append(result)
+
+            try:
+                self._configure(configs)
+            except Exception as err:
+                self.logger.error('Failed to apply queued changes, restoring gateway to previous state: %s', err)
+                for result in results:
+                    result.set_exception(err)
+                try:
+                    self._restore(configs, undos)
+                except Exception as err:
+                    self.logger.error('Failed to restore gateway to previous state: %s', err)
+            else:
+                for result in results:
+                    result.set(None)
+        finally:
+            # never leave a caller of queue_changes waiting, whatever interrupted the reconfiguration
+            for _, result in deferred['queue']:
+                if not result.ready():
+                    result.set_exception(RuntimeError('Gateway {} failed to apply the changes'.format(self.name)))
+
+    def _cancel_deferred(self):
+        """
+        Drop the scheduled reconfiguration and the queued changes
+        """
+        deferred = self._reset_deferred()
+        if deferred['greenlet'] is not None:
+            deferred['greenlet'].kill()
+        for _, result in deferred['queue']:
+            result.set_exception(RuntimeError('Gateway {} stopped before applying the changes'.format(self.name)))
+
+    def _reset_deferred(self):
+        """
+        Reset the queued changes
+        :return: the queued changes before the reset
+        """
+        deferred = self._deferred
+        self._deferred = {'queue': [], 'greenlet': None}
+        return deferred
+
+    def _undo_changes(self, undos):
+        for undo in reversed(undos):
+            undo()
+
+    def _restore(self, configs, undos):
+        """
+        Undo changes and reconfigure the parts of the gateway they affected, even if undoing the changes failed
+        """
+        try:
+            self._undo_changes(undos)
+        finally:
+            self._configure(configs)
+
+    def _configure(self, configs):
+        """
+        Reconfigure parts of the gateway
+        :param configs: set of the parts to reconfigure: 'fw', 'http' and 'dhcp'
+        """
+        gateway_sal = self._gateway_sal
+        if 'fw' in configs:
+            # the sal renders and loads the whole nftables ruleset, it has no way to add or delete single rules
+            gateway_sal.configure_fw()
+        if 'http' in configs:
+            gateway_sal.configure_http()
+        if 'dhcp' in configs:
+            gateway_sal.configure_dhcp()
+            gateway_sal.configure_cloudinit()
+
+    # The change methods below validate a change and apply it to the service data.
+    # They return the part of the gateway to reconfigure and a function undoing the change,
+    # or (None, None) if there is nothing to change.
+
+    def _add_portforward(self, forward):
+        indexes = self._indexes()
+        self._get_network(forward['srcnetwork'])
+        if forward['name'] in indexes['forwards']:
+            raise ValueError('A forward with the same name exists')
+        if any(port in indexes['ports'] for port in _forward_ports(forward)):
+            raise ValueError('Forward conflicts with existing forward')
+        return 'fw', self._add_item(self.data['portforwards'], forward, self._index_forward, self._unindex_forward)
+
+    def _remove_portforward(self, name):
+        forward = self._indexes()['forwards'].get(name)
+        if forward is None:
+            return None, None
+        return 'fw', self._remove_item(self.data['portforwards'], forward, self._index_forward, self._unindex_forward)
+
+    def _add_http_proxy(self, proxy):
+        indexes = self._indexes()
+        if proxy['name'] in indexes['proxies']:
+            raise ValueError('A proxy with the same name exists')
+        if proxy['host'] in indexes['proxy_hosts']:
+            raise ValueError("Proxy with host {} already exists".format(proxy['host']))
+        return 'http', self._add_item(self.data['httpproxies'], proxy, self._index_proxy, self._unindex_proxy)
+
+    def _remove_http_proxy(self, name):
+        proxy = self._indexes()['proxies'].get(name)
+        if proxy is None:
+            return None, None
+        return 'http', self._remove_item(self.data['httpproxies'], proxy, self._index_proxy, self._unindex_proxy)
+
+    def _add_dhcp_host(self, network_name, host):
+        hosts = self._get_network(network_name)['dhcpserver']['hosts']
+        if (network_name, host['macaddress']) in self._indexes()['macs']:
+            raise ValueError('Host with macaddress {} already exists'.format(host['macaddress']))
+        index = functools.partial(self._index_dhcp_host, network_name)
+        unindex = functools.partial(self._unindex_dhcp_host, network_name)
+        return 'dhcp', self._add_item(hosts, host, index, unindex)
+
+    def _remove_dhcp_host(self, network_name, host):
+        hosts = self._get_network(network_name)['dhcpserver']['hosts']
+        existing_host = self._indexes()['macs'].get((network_name, host['macaddress']))
+        if existing_host is None:
+            raise LookupError('Host with macaddress {} doesn\'t exist'.format(host['macaddress']))
+        index = functools.partial(self._index_dhcp_host, network_name)
+        unindex = functools.partial(self._unindex_dhcp_host, network_name)
+        return 'dhcp', self._remove_item(hosts, existing_host, index, unindex)
 
-    def _compare_objects(self, obj1, obj2, *keys):
+    def _add_item(self, items, item, index, unindex):
         """
-        Checks that obj1 and obj2 have different names, and that the combination of values from keys are unique
-        :param obj1: first dict to use for comparison
-        :param obj2: second dict to use for comparison
-        :param keys: keys to use for value comparison
-        :return: a tuple of bool, where the first element indicates whether the name matches or not,
-        and the second element indicates whether the combination of values matches or not
+        Append item to items and index it
+        :return: function undoing the change, it does nothing if item was removed since
         """
-        name = obj1['name'] == obj2['name']
-        for key in keys:
-            if obj1[key] != obj2[key]:
-                return name, False
-        return name, True
+        items.append(item)
+        index(item)
+        self._data_changed()
+
+        def undo():
+            if item not in items:
+                return
+            items.remove(item)
+            unindex(item)
+            self._data_changed()
+        return undo
+
+    def _remove_item(self, items, item, index, unindex):
+        """
+        Remove item from items and unindex it
+        :return: function undoing the change, it does nothing if item was added back since
+        """
+        position = items.index(item)
+        del items[position]
+        unindex(item)
+        self._data_changed()
+
+        def undo():
+            if item in items:
+                return
+            items.insert(position, item)
+            index(item)
+            self._data_changed()
+        return undo
+
+    def _get_network(self, name):
+        network = self._indexes()['networks'].get(name)
+        if network is None:
+            raise LookupError('Network with name {} doesn\'t exist'.format(name))
+        return network
+
+    def _indexes(self):
+        """
+        Indexes of the port forwards, http proxies, networks and dhcp hosts, to check conflicts and
+        look them up by name without scanning the service data:
+        - forwards: name -> port forward
+        - ports: (srcnetwork, srcport, protocol) -> port forward
+        - proxies: name -> http proxy
+        - proxy_hosts: host -> http proxy
+        - networks: name -> network
+        - network_ids: (type, id) -> network
+        - macs: (network name, macaddress) -> dhcp host
+        The change methods keep the indexes up to date. They are rebuilt when one of the indexed lists
+        was replaced, like when the service data is updated, or when a network was added or removed.
+        """
+        sources = [self.data['portforwards'], self.data['httpproxies'], self.data['networks']]
+        sources.extend((network.get('dhcpserver') or {}).get('hosts') for network in self.data['networks'])
+        if self._indexes_cache is not None:
+            cached_sources, indexes = self._indexes_cache
+            if len(cached_sources) == len(sources) and all(a is b for a, b in zip(cached_sources, sources)):
+                return indexes
+
+        indexes = {'forwards': {}, 'ports': {}, 'proxies': {}, 'proxy_hosts': {},
+                   'networks': {}, 'network_ids': {}, 'macs': {}}
+        for forward in self.data['portforwards']:
+            indexes['forwards'][forward['name']] = forward
+            for port in _forward_ports(forward):
+                indexes['ports'][port] = forward
+        for proxy in self.data['httpproxies']:
+            indexes['proxies'][proxy['name']] = proxy
+            indexes['proxy_hosts'][proxy['host']] = proxy
+        for network in self.data['networks']:
+            indexes['networks'][network['name']] = network
+            indexes['network_ids'][(network.get('type'), network.get('id'))] = network
+            for host in (network.get('dhcpserver') or {}).get('hosts') or []:
+                indexes['macs'][(network['name'], host['macaddress'])] = host
+        self._indexes_cache = (sources, indexes)
+        return indexes
+
+    def _index_forward(self, forward):
+        indexes = self._indexes()
+        indexes['forwards'][forward['name']] = forward
+        for port in _forward_ports(forward):
+            indexes['ports'][port] = forward
+
+    def _unindex_forward(self, forward):
+        indexes = self._indexes()
+        indexes['forwards'].pop(forward['name'], None)
+        for port in _forward_ports(forward):
+            indexes['ports'].pop(port, None)
+
+    def _index_proxy(self, proxy):
+        indexes = self._indexes()
+        indexes['proxies'][proxy['name']] = proxy
+        indexes['proxy_hosts'][proxy['host']] = proxy
+
+    def _unindex_proxy(self, proxy):
+        indexes = self._indexes()
+        indexes['proxies'].pop(proxy['name'], None)
+        indexes['proxy_hosts'].pop(proxy['host'], None)
+
+    def _index_dhcp_host(self, network_name, host):
+        self._indexes()['macs'][(network_name, host['macaddress'])] = host
+
+    def _unindex_dhcp_host(self, network_name, host):
+        self._indexes()['macs'].pop((network_name, host['macaddress']), None)
 
     def add_network(self, network):
         self.logger.info('Add network {}'.format(network['name']))
         self.state.check('actions', 'start', 'ok')
 
-        for existing_network in self.data['networks']:
-            name, combination = self._compare_objects(existing_network, network, 'type', 'id')
-            if name:
-                raise ValueError('Network with name {} already exists'.format(name))
-            if combination:
+        with self._configure_lock:
+            self._flush_deferred()
+            indexes = self._indexes()
+            if network['name'] in indexes['networks']:
+                raise ValueError('Network with name {} already exists'.format(network['name']))
+            if (network['type'], network['id']) in indexes['network_ids']:
                 raise ValueError('network with same type/id combination already exists')
-        self.data['networks'].append(network)
+            self.data['networks'].append(network)
+            self._data_changed()
 
-        try:
-            self._gateway_sal.deploy()
-        except:
-            self.logger.error('Failed to add network, restoring gateway to previous state')
-            self.data['networks'].remove(network)
-            self._gateway_sal.deploy()
-            raise
+            try:
+                self._gateway_sal.deploy()
+            except:
+                self.logger.error('Failed to add network, restoring gateway to previous state')
+                self.data['networks'].remove(network)
+                self._data_changed()
+                self._gateway_sal.deploy()
+                raise
 
     def remove_network(self, name):
         self.logger.info('Remove network {}'.format(name))
         self.state.check('actions', 'start', 'ok')
 
-        for network in self.data['networks']:
-            if network['name'] == name:
-                self.data['networks'].remove(network)
-                break
-        else:
-            return
-        try:
-            self._gateway_sal.deploy()
-        except:
-            self.logger.error('Failed to remove network, restoring gateway to previous state')
-            self.data['networks'].append(network)
-            self._gateway_sal.deploy()
-            raise
+        with self._configure_lock:
+            self._flush_deferred()
+            network = self._indexes()['networks'].get(name)
+            if network is None:
+                return
+            self.data['networks'].remove(network)
+            self._data_changed()
+            try:
+                self._gateway_sal.deploy()
+            except:
+                self.logger.error('Failed to remove network, restoring gateway to previous state')
+                self.data['networks'].append(network)
+                self._data_changed()
+                self._gateway_sal.deploy()
+                raise
 
     def info(self):
         data = self._gateway_sal.to_dict(live=True)
@@ -255,12 +568,14 @@ class Gateway(TemplateBase):
 
     def uninstall(self):
         self.logger.info('Uninstall gateway {}'.format(self.name))
+        self._cancel_deferred()
         self._gateway_sal.stop()
         self.state.delete('actions', 'install')
         self.state.delete('actions', 'start')
 
     def stop(self):
         self.logger.info('Stop gateway {}'.format(self.name))
+        self._cancel_deferred()
         self._gateway_sal.stop()
         self.state.delete('actions', 'start')
         self.state.delete('state', 'running')
@@ -269,3 +584,10 @@ class Gateway(TemplateBase):
         self.logger.info('Start gateway {}'.format(self.name))
         self.state.check('actions', 'install', 'ok')
         self.install()
+
+
+def _forward_ports(forward):
+    """
+    Keys of the ports index used by a port forward: (srcnetwork, srcport, protocol)
+    """
+    return [(forward['srcnetwork'], forward['srcport'], protocol) for protocol in forward['protocols']]
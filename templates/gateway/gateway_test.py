@@ -2,9 +2,11 @@ from unittest.mock import MagicMock, patch, call
 import copy
 import os
 import pytest
+import gevent
+from gevent.event import AsyncResult
 
 
-from gateway import Gateway, NODE_CLIENT
+from gateway import Gateway, NODE_CLIENT, RECONFIGURE_DELAY
 from zerorobot.template.state import StateCheckError
 
 from JumpScale9Zrobot.test.utils import ZrobotBaseTest
@@ -58,6 +60,19 @@ class TestGatewayTemplate(ZrobotBaseTest):
         assert gw._gateway_sal == gw_sal
         gw._node_sal.primitives.from_dict.assert_called_once_with('gateway', self.valid_data)
 
+    def test_gateway_sal_cached(self):
+        """
+        Test _gateway_sal property is only rebuilt when the data changes
+        """
+        gw = Gateway('gw', data=self.valid_data)
+        gw._gateway_sal
+        gw._gateway_sal
+        assert gw._node_sal.primitives.from_dict.call_count == 1
+
+        gw.update_data({'hostname': 'newhostname'})
+        gw._gateway_sal
+        assert gw._node_sal.primitives.from_dict.call_count == 2
+
     def test_install(self):
         """
         Test install action
@@ -159,6 +174,21 @@ class TestGatewayTemplate(ZrobotBaseTest):
         gw.add_portforward(portforward_two)
         assert gw.data['portforwards'] == [portforward_one, portforward_two]
 
+    def test_add_portforward_data_updated(self):
+        """
+        Test add_portforward action detects conflicts with forwards set by a data update
+        """
+        self.valid_data['networks'] = [{'name': 'network'}]
+        gw = Gateway('gw', data=self.valid_data)
+        gw.state.set('actions', 'start', 'ok')
+        portforward = {'name': 'pf', 'dstip': '196.23.12.42', 'dstport': 22, 'srcnetwork': 'network', 'srcport': 22, 'protocols': ['tcp']}
+        gw.add_portforward(portforward)
+        gw.data['portforwards'] = [{'name': 'pf2', 'dstip': '196.23.12.42', 'dstport': 23, 'srcnetwork': 'network', 'srcport': 23, 'protocols': ['tcp']}]
+
+        gw.add_portforward(portforward)
+        with pytest.raises(ValueError, message='action should raise an error if the forward conflicts with the updated data'):
+            gw.add_portforward(dict(portforward, name='pf3', srcport=23))
+
     def test_remove_portforward(self):
         """
         Test remove_portforward action
@@ -169,6 +199,25 @@ class TestGatewayTemplate(ZrobotBaseTest):
         gw.remove_portforward('pf')
         assert gw.data['portforwards'] == []
 
+    def test_remove_portforward_undo(self):
+        """
+        Test removing port forwards keeps the order of the other forwards and is undone in place
+        """
+        forwards = [{'name': name, 'dstip': '196.23.12.42', 'dstport': port, 'srcnetwork': 'network',
+                     'srcport': port, 'protocols': ['tcp']} for name, port in (('pf1', 21), ('pf2', 22), ('pf3', 23))]
+        self.valid_data['portforwards'] = list(forwards)
+        gw = Gateway('gw', data=self.valid_data)
+
+        _, undo1 = gw._remove_portforward('pf1')
+        assert [forward['name'] for forward in gw.data['portforwards']] == ['pf2', 'pf3']
+        _, undo2 = gw._remove_portforward('pf2')
+        assert [forward['name'] for forward in gw.data['portforwards']] == ['pf3']
+
+        undo2()
+        undo1()
+        assert gw.data['portforwards'] == forwards
+        assert sorted(gw._indexes()['forwards']) == ['pf1', 'pf2', 'pf3']
+
     def test_remove_portforward_exception(self):
         """
         Test remove_portforward action raises exception
@@ -227,6 +276,36 @@ class TestGatewayTemplate(ZrobotBaseTest):
             assert gw.data['httpproxies'] == []
             assert gw._gateway_sal.configure_http.call_count == 2
 
+    def test_add_http_proxy_flushes_queue(self):
+        """
+        Test the queued changes are applied before a change made by an action
+        """
+        greenlet = MagicMock()
+        gw = Gateway('gw', data=self.valid_data)
+        gw.state.set('actions', 'start', 'ok')
+        result = AsyncResult()
+        proxy = {'name': 'proxy', 'host': 'host', 'destinations': ['192.168.1.1'], 'types': ['http']}
+        gw._deferred = {'queue': [([{'action': 'add_http_proxy', 'args': {'proxy': proxy}}], result)], 'greenlet': greenlet}
+        gw.remove_http_proxy('proxy')
+
+        assert result.successful()
+        assert gw.data['httpproxies'] == []
+        assert gw._gateway_sal.configure_http.call_count == 2
+        greenlet.kill.assert_called_once_with(block=False)
+        assert gw._deferred['queue'] == []
+
+    def test_undo_removed_item(self):
+        """
+        Test undoing the addition of an item that was removed since does nothing
+        """
+        gw = Gateway('gw', data=self.valid_data)
+        _, undo = gw._add_http_proxy({'name': 'proxy', 'host': 'host', 'destinations': ['192.168.1.1'], 'types': ['http']})
+        gw._remove_http_proxy('proxy')
+        undo()
+
+        assert gw.data['httpproxies'] == []
+        assert gw._indexes()['proxies'] == {}
+
     def test_add_http_proxy_before_start(self):
         """
         Test add_http_proxy action before gateway start
@@ -421,6 +500,188 @@ class TestGatewayTemplate(ZrobotBaseTest):
             gw.state.set('actions', 'start', 'ok')
             gw.remove_dhcp_host('network', {'macaddress': 'address2'})
 
+    def test_apply_changes(self):
+        """
+        Test apply_changes action reconfigures each affected part of the gateway once
+        """
+        self.valid_data['networks'] = [{'name': 'network', 'dhcpserver': {'hosts': []}}]
+        self.valid_data['portforwards'] = [{'name': 'pf', 'dstip': '196.23.12.42', 'dstport': 21, 'srcnetwork': 'network', 'srcport': 21, 'protocols': ['tcp']}]
+        gw = Gateway('gw', data=self.valid_data)
+        gw.state.set('actions', 'start', 'ok')
+        forward1 = {'name': 'pf1', 'dstip': '196.23.12.42', 'dstport': 22, 'srcnetwork': 'network', 'srcport': 22, 'protocols': ['tcp']}
+        forward2 = {'name': 'pf2', 'dstip': '196.23.12.42', 'dstport': 23, 'srcnetwork': 'network', 'srcport': 23, 'protocols': ['tcp']}
+        proxy = {'name': 'proxy', 'host': 'host', 'destinations': ['192.168.1.1'], 'types': ['http']}
+        gw.apply_changes([
+            {'action': 'add_portforward', 'args': {'forward': forward1}},
+            {'action': 'add_portforward', 'args': {'forward': forward2}},
+            {'action': 'remove_portforward', 'args': {'name': 'pf'}},
+            {'action': 'add_http_proxy', 'args': {'proxy': proxy}},
+        ])
+
+        assert gw.data['portforwards'] == [forward1, forward2]
+        assert gw.data['httpproxies'] == [proxy]
+        gw._gateway_sal.configure_fw.assert_called_once_with()
+        gw._gateway_sal.configure_http.assert_called_once_with()
+        assert not gw._gateway_sal.configure_dhcp.called
+
+    def test_queue_changes(self):
+        """
+        Test the queued changes are applied with one reconfiguration and each caller gets its own outcome
+        """
+        self.valid_data['networks'] = [{'name': 'network'}]
+        gw = Gateway('gw', data=self.valid_data)
+        gw.state.set('actions', 'start', 'ok')
+        forward1 = {'name': 'pf1', 'dstip': '196.23.12.42', 'dstport': 22, 'srcnetwork': 'network', 'srcport': 22, 'protocols': ['tcp']}
+        forward2 = {'name': 'pf2', 'dstip': '196.23.12.42', 'dstport': 23, 'srcnetwork': 'network', 'srcport': 23, 'protocols': ['tcp']}
+        results = [MagicMock(), MagicMock(), MagicMock()]
+        gw._deferred['queue'] = [
+            ([{'action': 'add_portforward', 'args': {'forward': forward1}}], results[0]),
+            ([{'action': 'add_portforward', 'args': {'forward': dict(forward2, srcport=22)}}], results[1]),
+            ([{'action': 'add_portforward', 'args': {'forward': forward2}}], results[2]),
+        ]
+        gw._configure_deferred()
+
+        assert gw.data['portforwards'] == [forward1, forward2]
+        gw._gateway_sal.configure_fw.assert_called_once_with()
+        results[0].set.assert_called_once_with(None)
+        assert isinstance(results[1].set_exception.call_args[0][0], ValueError)
+        results[2].set.assert_called_once_with(None)
+
+    def test_queue_changes_exception(self):
+        """
+        Test the queued changes are undone and all the callers get the error if the gateway fails to be reconfigured
+        """
+        self.valid_data['networks'] = [{'name': 'network'}]
+        gw = Gateway('gw', data=self.valid_data)
+        gw.state.set('actions', 'start', 'ok')
+        gw._gateway_sal.configure_fw.side_effect = [RuntimeError, None]
+        forward = {'name': 'pf', 'dstip': '196.23.12.42', 'dstport': 22, 'srcnetwork': 'network', 'srcport': 22, 'protocols': ['tcp']}
+        result = MagicMock()
+        gw._deferred['queue'] = [([{'action': 'add_portforward', 'args': {'forward': forward}}], result)]
+        gw._configure_deferred()
+
+        assert gw.data['portforwards'] == []
+        assert gw._gateway_sal.configure_fw.call_count == 2
+        assert isinstance(result.set_exception.call_args[0][0], RuntimeError)
+        assert not result.set.called
+
+    def test_queue_changes_timeout(self):
+        """
+        Test queue_changes raises and drops its changes if they are not applied in time
+        """
+        spawn_later = patch('gevent.spawn_later', MagicMock()).start()
+        patch('gateway.QUEUED_CHANGES_TIMEOUT', 0.01).start()
+        gw = Gateway('gw', data=self.valid_data)
+        gw.state.set('actions', 'start', 'ok')
+        with pytest.raises(TimeoutError, message='queue_changes should raise an error if the changes are not applied in time'):
+            gw.queue_changes([{'action': 'remove_portforward', 'args': {'name': 'pf'}}])
+
+        spawn_later.assert_called_once_with(RECONFIGURE_DELAY, gw._configure_deferred)
+        assert gw._deferred['queue'] == []
+
+    def test_queue_changes_taken(self):
+        """
+        Test queue_changes waits for its changes once they are being applied, even past its timeout
+        """
+        patch('gateway.RECONFIGURE_DELAY', 0).start()
+        patch('gateway.QUEUED_CHANGES_TIMEOUT', 0.01).start()
+        self.valid_data['networks'] = [{'name': 'network'}]
+        gw = Gateway('gw', data=self.valid_data)
+        gw.state.set('actions', 'start', 'ok')
+        gw._gateway_sal.configure_fw.side_effect = lambda: gevent.sleep(0.05)
+        forward = {'name': 'pf', 'dstip': '196.23.12.42', 'dstport': 22, 'srcnetwork': 'network', 'srcport': 22, 'protocols': ['tcp']}
+
+        gw.queue_changes([{'action': 'add_portforward', 'args': {'forward': forward}}])
+
+        assert gw.data['portforwards'] == [forward]
+        gw._gateway_sal.configure_fw.assert_called_once_with()
+
+    def test_queue_changes_interrupted(self):
+        """
+        Test the callers of queue_changes get an error if the reconfiguration is interrupted
+        """
+        gw = Gateway('gw', data=self.valid_data)
+        gw._change_batches = MagicMock(side_effect=RuntimeError)
+        result = AsyncResult()
+        gw._deferred['queue'] = [([{'action': 'remove_portforward', 'args': {'name': 'pf'}}], result)]
+        with pytest.raises(RuntimeError):
+            gw._configure_deferred()
+
+        assert isinstance(result.exception, RuntimeError)
+
+    def test_apply_changes_not_atomic(self):
+        """
+        Test apply_changes action applies the valid changes and returns the outcome of each change
+        """
+        self.valid_data['networks'] = [{'name': 'network'}]
+        gw = Gateway('gw', data=self.valid_data)
+        gw.state.set('actions', 'start', 'ok')
+        forward = {'name': 'pf', 'dstip': '196.23.12.42', 'dstport': 22, 'srcnetwork': 'network', 'srcport': 22, 'protocols': ['tcp']}
+        proxy = {'name': 'proxy', 'host': 'host', 'destinations': ['192.168.1.1'], 'types': ['http']}
+        results = gw.apply_changes([
+            {'action': 'add_portforward', 'args': {'forward': forward}},
+            {'action': 'add_portforward', 'args': {'forward': forward}},
+            {'action': 'add_http_proxy', 'args': {'proxy': proxy}},
+        ], atomic=False)
+
+        assert [result['error'] is None for result in results] == [True, False, True]
+        assert gw.data['portforwards'] == [forward]
+        assert gw.data['httpproxies'] == [proxy]
+        gw._gateway_sal.configure_fw.assert_called_once_with()
+        gw._gateway_sal.configure_http.assert_called_once_with()
+
+    def test_apply_changes_undo_exception(self):
+        """
+        Test apply_changes action reconfigures the gateway even if undoing the changes fails
+        """
+        self.valid_data['networks'] = [{'name': 'network'}]
+        gw = Gateway('gw', data=self.valid_data)
+        gw.state.set('actions', 'start', 'ok')
+        gw._gateway_sal.configure_fw.side_effect = [RuntimeError, None]
+        gw._undo_changes = MagicMock(side_effect=ValueError)
+        forward = {'name': 'pf', 'dstip': '196.23.12.42', 'dstport': 22, 'srcnetwork': 'network', 'srcport': 22, 'protocols': ['tcp']}
+        with pytest.raises(ValueError, message='action should raise an error if the changes fail to be undone'):
+            gw.apply_changes([{'action': 'add_portforward', 'args': {'forward': forward}}])
+
+        assert gw._gateway_sal.configure_fw.call_count == 2
+
+    def test_apply_changes_invalid(self):
+        """
+        Test apply_changes action doesn't apply any change if one of them is not valid
+        """
+        self.valid_data['networks'] = [{'name': 'network'}]
+        gw = Gateway('gw', data=self.valid_data)
+        gw.state.set('actions', 'start', 'ok')
+        forward = {'name': 'pf', 'dstip': '196.23.12.42', 'dstport': 22, 'srcnetwork': 'network', 'srcport': 22, 'protocols': ['tcp']}
+        with pytest.raises(ValueError, message='action should raise an error if a change conflicts with another one'):
+            gw.apply_changes([
+                {'action': 'add_portforward', 'args': {'forward': forward}},
+                {'action': 'add_portforward', 'args': {'forward': forward}},
+            ])
+
+        assert gw.data['portforwards'] == []
+        assert not gw._gateway_sal.configure_fw.called
+
+    def test_apply_changes_exception(self):
+        """
+        Test apply_changes action restores the gateway if it fails to be reconfigured
+        """
+        forwards = [{'name': 'pf', 'dstip': '196.23.12.42', 'dstport': 21, 'srcnetwork': 'network', 'srcport': 21, 'protocols': ['tcp']}]
+        self.valid_data['networks'] = [{'name': 'network'}]
+        self.valid_data['portforwards'] = copy.deepcopy(forwards)
+        gw = Gateway('gw', data=self.valid_data)
+        gw.state.set('actions', 'start', 'ok')
+        gw._gateway_sal.configure_fw.side_effect = [RuntimeError, None]
+        forward = {'name': 'pf1', 'dstip': '196.23.12.42', 'dstport': 22, 'srcnetwork': 'network', 'srcport': 22, 'protocols': ['tcp']}
+        with pytest.raises(RuntimeError, message='action should raise an error if configure_fw raises an exception'):
+            gw.apply_changes([
+                {'action': 'remove_portforward', 'args': {'name': 'pf'}},
+                {'action': 'add_portforward', 'args': {'forward': forward}},
+            ])
+
+        assert gw.data['portforwards'] == forwards
+        assert gw._gateway_sal.configure_fw.call_count == 2
+
     def test_start(self):
         """
         Test start action
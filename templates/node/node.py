@@ -1,8 +1,16 @@
+import collections
+import hashlib
+import json
+import time
+
+import gevent
+from gevent.lock import BoundedSemaphore
 
 from js9 import j
 from zerorobot.template.base import TemplateBase
 from zerorobot.template.decorator import retry, timeout
 from zerorobot.template.state import StateCheckError
+from zerorobot.service_collection import ServiceNotFoundError
 import netaddr
 
 CONTAINER_TEMPLATE_UID = 'github.com/zero-os/0-templates/container/0.0.1'
@@ -10,7 +18,9 @@ VM_TEMPLATE_UID = 'github.com/zero-os/0-templates/vm/0.0.1'
 BOOTSTRAP_TEMPLATE_UID = 'github.com/zero-os/0-templates/zeroos_bootstrap/0.0.1'
 ZDB_TEMPLATE_UID = 'github.com/zero-os/0-templates/zerodb/0.0.1'
 NODE_CLIENT = 'local'
-
+CAPACITY_REFRESH_INTERVAL = 5 * 60  # seconds between two capacity refreshes by _monitor while the mounted disks don't change
+CAPACITY_HEARTBEAT = 60 * 60  # seconds after which the capacity is registered again even if it didn't change
+ALLOCATIONS_TRACE_SIZE = 1000  # number of namespace allocations kept to replay with simulate_placement
 
 class Node(TemplateBase):
 
@@ -21,10 +31,21 @@ class Node(TemplateBase):
         super().__init__(name=name, guid=guid, data=data)
         self.recurring_action('_monitor', 30)  # every 30 seconds
         self.recurring_action('_register', 10 * 60)  # every 10 minutes
+        self._capacity = None
+        self._capacity_refreshed = (None, 0)  # (mounted disks, time) of the last capacity refresh
+        self._last_placement = None
+        self._allocations = collections.deque(maxlen=ALLOCATIONS_TRACE_SIZE)
+        self._reservations = {}  # zerodb path -> {namespace name: bytes} for the namespaces being created
+        self._placement_lock = BoundedSemaphore()
+        self._capacity_pushes = {}  # kind of capacity report -> (digest, time) of the last push to the capacity directory
 
     def validate(self):
         self.state.delete('disks', 'mounted')
 
+        strategy = self.data.get('placementStrategy')
+        if strategy and strategy not in PLACEMENT_STRATEGIES:
+            raise ValueError('Placement strategy should be one of {}'.format(', '.join(PLACEMENT_STRATEGIES)))
+
         network = self.data.get('network')
         if network:
             self._validate_network(network)
@@ -61,10 +82,16 @@ class Node(TemplateBase):
         self.data['uptime'] = self.node_sal.uptime()
 
         try:
-            self.node_sal.zerodbs.partition_and_mount_disks()
+            mounted = self.node_sal.zerodbs.partition_and_mount_disks()
             self.state.set('disks', 'mounted', 'ok')
         except:
             self.state.delete('disks', 'mounted')
+        else:
+            if self._capacity_outdated(mounted):
+                try:
+                    self._refresh_capacity(mounted)
+                except Exception as err:
+                    self.logger.error('Failed to refresh capacity of node %s: %s' % (self.name, str(err)))
 
         try:
             # check if the node was rebooting and start containers and vms
@@ -83,13 +110,34 @@ class Node(TemplateBase):
         self.state.check('actions', 'install', 'ok')
         self.logger.info("register node capacity")
 
-        self.node_sal.capacity.register()
-        self.node_sal.capacity.update_reality()
-        self.node_sal.capacity.update_reserved(
-            vms=self.api.services.find(template_name='vm', template_account='zero-os'),
-            vdisks=self.api.services.find(template_name='vdisk', template_account='zero-os'),
-            gateways=self.api.services.find(template_name='gateway', template_account='zero-os'),
-        )
+        capacity = self.node_sal.capacity
+        self._push_capacity('total', capacity.total_report(), capacity.register)
+        self._push_capacity('reality', capacity.reality_report(), capacity.update_reality)
+
+        vms = self.api.services.find(template_name='vm', template_account='zero-os')
+        vdisks = self.api.services.find(template_name='vdisk', template_account='zero-os')
+        gateways = self.api.services.find(template_name='gateway', template_account='zero-os')
+        reserved = {kind: sorted((service.name, service.data) for service in services)
+                    for kind, services in (('vms', vms), ('vdisks', vdisks), ('gateways', gateways))}
+        self._push_capacity('reserved', reserved,
+                            lambda: capacity.update_reserved(vms=vms, vdisks=vdisks, gateways=gateways))
+
+    def _push_capacity(self, kind, report, push):
+        """
+        Push a capacity report to the capacity directory if it changed since the last push,
+        or if the last push is older than CAPACITY_HEARTBEAT
+        :param kind: name of the report
+        :param report: data the pushed report is computed from
+        :param push: function pushing the report
+        :return: True if the report was pushed
+        """
+        digest = hashlib.md5(json.dumps(report, sort_keys=True, default=str).encode()).hexdigest()
+        last_digest, last_push = self._capacity_pushes.get(kind, (None, 0))
+        if digest == last_digest and time.time() - last_push < CAPACITY_HEARTBEAT:
+            return False
+        push()
+        self._capacity_pushes[kind] = (digest, time.time())
+        return True
 
     def _rename_cache(self):
         """Rename old cache storage pool to new convention if needed"""
@@ -198,43 +246,200 @@ class Node(TemplateBase):
 
         namespace_name = j.data.idgenerator.generateXCharID(10) if not name else name
 
-        potentials = {info['mountpoint']: info['disk'] for info in self.node_sal.zerodbs.partition_and_mount_disks()}
-        tasks = []
+        refreshed = self._capacity is None
+        if refreshed:
+            self._refresh_capacity()
+        try:
+            return self._place_zdb_namespace(namespace_name, disktypes, mode, password, public, size)
+        except NoNamespaceAvailability:
+            if refreshed:
+                raise
+            # the capacity index might be outdated, e.g. a disk was added since the last refresh
+            self._refresh_capacity()
+            return self._place_zdb_namespace(namespace_name, disktypes, mode, password, public, size)
+        except:
+            # the capacity index doesn't match the node anymore, rebuild it on next use
+            self._capacity = None
+            raise
 
-        zdbs = self.api.services.find(template_uid=ZDB_TEMPLATE_UID)
-        for zdb in zdbs:
-            tasks.append(zdb.schedule_action('info'))
-        results = self._wait_all(tasks, timeout=120, die=True)
-        zdbinfo = sorted(list(zip(zdbs, results)), key=lambda x: x[1]['free'],  reverse=True)
-        for zdb, info in zdbinfo:
-            potentials.pop(info['path'])
-        if potentials:
-            # there are free disks that are not used lets use them first
-            disks = [(self.node_sal.disks.get(diskname), mountpoint) for mountpoint, diskname in potentials.items()]
-            disks = list(filter(lambda disk: (disk[0].size / 1024 ** 3) > size and disk[0].type.value in disktypes, disks))
-            disks.sort(key=lambda disk: disk[0].size, reverse=True)
-            if disks:
-                bestfreedisk, mountpoint = disks[0]
-                return self._create_zdb(namespace_name, bestfreedisk.name, mountpoint, mode, password, public, size), namespace_name
-        zdbinfo = list(filter(lambda info: info[0].data['mode'] == mode and (info[1]['free'] / 1024 ** 3) > size and info[1]['type'] in disktypes, zdbinfo))
-        if not zdbinfo:
-            message = 'Not enough free space for namespace creation with size {} and type {}'.format(size, ','.join(disktypes))
-            raise NoNamespaceAvailability(message)
+    def _place_zdb_namespace(self, namespace_name, disktypes, mode, password, public, size):
+        """
+        Create the namespace on the candidate chosen by the placement strategy.
+        The space of the namespace is reserved when the candidate is chosen, so concurrent placements
+        can't choose the same space, and released if the creation fails.
+        :return: tuple of the zerodb service name and the namespace name
+        """
+        with self._placement_lock:
+            candidate = self._choose_candidate(namespace_name, disktypes, mode, size)
+            self._reservations.setdefault(candidate['path'], {})[namespace_name] = size * 1024 ** 3
+            disk = None
+            if candidate['zdb'] is None:
+                # nobody else can use this disk until the zerodb is created on it
+                disk = self._capacity['disks'].pop(candidate['path'])
 
-        for bestzdb, _ in zdbinfo:
-            namespaces = [namespace['name'] for namespace in bestzdb.schedule_action('namespace_list').wait(die=True).result]
-            if namespace_name not in namespaces:
+        try:
+            if disk is not None:
+                zdb_name = self._create_zdb(namespace_name, disk['name'], disk['mountpoint'], mode, password, public, size)
+                self._capacity['zdbs'][zdb_name] = {
+                    'free': disk['size'],
+                    'size': disk['size'],
+                    'type': disk['type'],
+                    'mode': mode,
+                    'path': disk['mountpoint'],
+                }
+            else:
+                zdb_name = candidate['zdb']
                 kwargs = {
                     'name': namespace_name,
                     'size': size,
                     'password': password,
                     'public': public,
                 }
-                bestzdb.schedule_action('namespace_create', kwargs).wait(die=True)
-                return bestzdb.name, namespace_name
+                zdb = self.api.services.get(template_uid=ZDB_TEMPLATE_UID, name=zdb_name)
+                zdb.schedule_action('namespace_create', kwargs).wait(die=True)
+        except:
+            if disk is not None:
+                self._capacity['disks'][disk['mountpoint']] = disk
+            raise
+        finally:
+            # on success the namespace is now accounted for in the zerodb data
+            self._release_reservation(candidate['path'], namespace_name)
+
+        self._last_placement = candidate['path']
+        self._allocations.append({'disktype': disktypes[0], 'mode': mode, 'size': size})
+        return zdb_name, namespace_name
+
+    def _choose_candidate(self, namespace_name, disktypes, mode, size):
+        """
+        Choose where to create a namespace using the placement strategy of the node
+        :return: candidate dict with the keys path, free (bytes available) and zdb (zerodb service name or None for an unused disk)
+        """
+        # candidates are the unused disks and the zerodbs running in the requested mode
+        candidates = [{'path': disk['mountpoint'], 'free': disk['size'], 'zdb': None}
+                      for disk in self._capacity['disks'].values()
+                      if disk['type'] in disktypes and disk['mountpoint'] not in self._reservations]
+        exists = False
+        for zdb_name, zdb in self._capacity['zdbs'].items():
+            if zdb['mode'] != mode or zdb['type'] not in disktypes:
+                continue
+            try:
+                namespaces = self.api.services.get(template_uid=ZDB_TEMPLATE_UID, name=zdb_name).data['namespaces']
+            except ServiceNotFoundError:
+                continue
+            if namespace_name in [namespace['name'] for namespace in namespaces]:
+                exists = True
+                continue
+            candidates.append({'path': zdb['path'], 'free': self._available(zdb, namespaces), 'zdb': zdb_name})
+
+        candidates = [candidate for candidate in candidates if (candidate['free'] / 1024 ** 3) > size]
+        if not candidates:
+            if exists:
+                message = 'Namespace {} already exists on all zerodbs'.format(namespace_name)
+            else:
+                message = 'Not enough free space for namespace creation with size {} and type {}'.format(size, ','.join(disktypes))
+            raise NoNamespaceAvailability(message)
+
+        strategy = PLACEMENT_STRATEGIES[self.data.get('placementStrategy') or 'worstFit']
+        return strategy(candidates, self._last_placement)
+
+    def _available(self, zdb, namespaces):
+        """
+        Space of a zerodb that is not reserved yet.
+        This is the free space of the disk minus the size of the namespaces of the zerodb that don't use it yet
+        and minus the namespaces being created on it.
+        :param zdb: zerodb entry of the capacity index
+        :param namespaces: namespaces of the zerodb service
+        :return: available space in bytes
+        """
+        committed = sum(namespace['size'] or 0 for namespace in namespaces) * 1024 ** 3
+        available = min(zdb['free'], (zdb['size'] or zdb['free']) - committed)
+        return available - sum(self._reservations.get(zdb['path'], {}).values())
+
+    def _release_reservation(self, path, namespace_name):
+        """
+        Release the space reserved for a namespace being created
+        """
+        reservations = self._reservations.get(path, {})
+        reservations.pop(namespace_name, None)
+        if not reservations:
+            self._reservations.pop(path, None)
+
+    def _capacity_outdated(self, mounted):
+        """
+        Check if the capacity index needs a refresh: it was never built or dropped, the mounted disks changed
+        or it is older than CAPACITY_REFRESH_INTERVAL. In between, the namespace allocations keep it up to date.
 
-        message = 'Namespace {} already exists on all zerodbs'.format(namespace_name)
-        raise NoNamespaceAvailability(message)
+        :param mounted: result of partition_and_mount_disks
+        """
+        if self._capacity is None:
+            return True
+        disks, refreshed = self._capacity_refreshed
+        if disks != _mounted_disks(mounted):
+            return True
+        return time.time() - refreshed > CAPACITY_REFRESH_INTERVAL
+
+    def _refresh_capacity(self, mounted=None):
+        """
+        Rebuild the capacity index used to place zdb namespaces.
+        The index holds the mounted disks that are not used by a zerodb yet and the free space,
+        disk size, disk type and mode of every zerodb of the node.
+
+        :param mounted: result of partition_and_mount_disks, called if not supplied
+        """
+        if mounted is None:
+            mounted = self.node_sal.zerodbs.partition_and_mount_disks()
+        potentials = {info['mountpoint']: info['disk'] for info in mounted}
+        disks = {disk.name: disk for disk in self.node_sal.disks.list()}
+
+        zdbs = self.api.services.find(template_uid=ZDB_TEMPLATE_UID)
+        results = self._wait_all([zdb.schedule_action('info') for zdb in zdbs], timeout=30)
+        capacity = {'zdbs': {}, 'disks': {}}
+        for zdb, info in zip(zdbs, results):
+            diskname = potentials.pop(zdb.data['path'], None)
+            if info is None:
+                # the zerodb didn't answer, don't place namespaces on it until next refresh
+                continue
+            disk = disks.get(diskname)
+            capacity['zdbs'][zdb.name] = {
+                'free': info['free'],
+                'size': disk.size if disk else None,
+                'type': info['type'],
+                'mode': zdb.data['mode'],
+                'path': info['path'],
+            }
+
+        for mountpoint, diskname in potentials.items():
+            disk = disks.get(diskname)
+            if disk is None:
+                continue
+            capacity['disks'][mountpoint] = {
+                'name': disk.name,
+                'size': disk.size,
+                'type': disk.type.value,
+                'mountpoint': mountpoint,
+            }
+        self._capacity = capacity
+        self._capacity_refreshed = (_mounted_disks(mounted), time.time())
+
+    def simulate_placement(self, trace=None, disks=None):
+        """
+        Replay an allocation trace with every placement strategy on empty disks
+        :param trace: list of allocations, dicts with the keys disktype (HDD or SSD), mode and size in GiB.
+                      Defaults to the allocations done by this node since the robot started
+        :param disks: list of disks, dicts with the keys name, type and size in bytes.
+                      Defaults to the disks in the capacity index of this node
+        :return: dict mapping each strategy name to the report of the simulation, see _simulate_placement
+        """
+        if trace is None:
+            trace = list(self._allocations)
+        if disks is None:
+            if self._capacity is None:
+                self._refresh_capacity()
+            disks = [{'name': disk['name'], 'type': disk['type'], 'size': disk['size']}
+                     for disk in self._capacity['disks'].values()]
+            disks.extend({'name': zdb['path'], 'type': zdb['type'], 'size': zdb['size']}
+                         for zdb in self._capacity['zdbs'].values() if zdb['size'])
+        return {name: _simulate_placement(strategy, disks, trace) for name, strategy in PLACEMENT_STRATEGIES.items()}
 
     def reboot(self):
         self._stop_all_containers()
@@ -261,8 +466,10 @@ class Node(TemplateBase):
         return self.node_sal.client.ping()[13:].strip()
 
     def _start_all_containers(self):
+        tasks = []
         for container in self.api.services.find(template_uid=CONTAINER_TEMPLATE_UID):
-            container.schedule_action('start')
+            tasks.append(container.schedule_action('start'))
+        self._wait_all(tasks)
 
     def _start_all_vms(self):
         # TODO
@@ -279,11 +486,154 @@ class Node(TemplateBase):
         pass
 
     def _wait_all(self, tasks, timeout=60, die=False):
+        """
+        Wait for all the tasks concurrently.
+        The timeout is a single deadline shared by all the tasks, not a per task timeout.
+
+        :param tasks: list of tasks to wait for
+        :param timeout: time in seconds to wait for all the tasks to finish
+        :param die: if True, raise TasksError when any task failed or did not finish in time
+        :return: list of the results of the tasks, in the same order as tasks.
+                 The result of a task that failed or did not finish in time is None
+        """
+        def wait(task):
+            try:
+                task.wait(timeout=timeout, die=die)
+            except Exception as err:
+                return None, err
+            if task.state == 'error':
+                return None, RuntimeError(task.eco.errormessage)
+            return task.result, None
+
+        greenlets = [gevent.spawn(wait, task) for task in tasks]
+        gevent.joinall(greenlets, timeout=timeout)
+
         results = []
-        for t in tasks:
-            results.append(t.wait(timeout=timeout, die=die).result)
+        errors = {}
+        for task, greenlet in zip(tasks, greenlets):
+            if greenlet.ready():
+                result, err = greenlet.value
+            else:
+                greenlet.kill(block=False)
+                result, err = None, TimeoutError('task did not finish within %s seconds' % timeout)
+            if err is not None:
+                errors[task] = err
+            results.append(result)
+
+        for task, err in errors.items():
+            self.logger.error('task %s failed: %s' % (task.guid, str(err)))
+
+        if errors and die:
+            raise TasksError(results, errors)
         return results
 
 
+class TasksError(Exception):
+    """
+    Raised by Node._wait_all when some of the tasks failed or timed out
+    results: list of the results of the tasks, None for the failed ones
+    errors: dict mapping the failed tasks to their error
+    """
+
+    def __init__(self, results, errors):
+        super().__init__('%s of %s tasks failed: %s' % (
+            len(errors), len(results), ', '.join(str(err) for err in errors.values())))
+        self.results = results
+        self.errors = errors
+
+
 class NoNamespaceAvailability(Exception):
     pass
+
+
+def _mounted_disks(mounted):
+    """
+    :param mounted: result of partition_and_mount_disks
+    :return: set of the (mountpoint, disk name) of the mounted disks
+    """
+    return {(info['mountpoint'], info['disk']) for info in mounted}
+
+
+def _worst_fit(candidates, last_path):
+    """
+    Prefer unused disks, biggest first, then the zerodb with the most free space
+    """
+    return max(candidates, key=lambda candidate: (candidate['zdb'] is None, candidate['free']))
+
+
+def _best_fit(candidates, last_path):
+    """
+    Use the disk or zerodb with the least free space that fits the namespace
+    """
+    return min(candidates, key=lambda candidate: candidate['free'])
+
+
+def _pack(candidates, last_path):
+    """
+    Fill the existing zerodbs, fullest first, and only use a new disk when no zerodb fits
+    """
+    return min(candidates, key=lambda candidate: (candidate['zdb'] is None, candidate['free']))
+
+
+def _spread(candidates, last_path):
+    """
+    Go round robin over the disks, using the next disk after the last one used
+    """
+    candidates = sorted(candidates, key=lambda candidate: candidate['path'])
+    for candidate in candidates:
+        if last_path is None or candidate['path'] > last_path:
+            return candidate
+    return candidates[0]
+
+
+PLACEMENT_STRATEGIES = {
+    'worstFit': _worst_fit,
+    'bestFit': _best_fit,
+    'pack': _pack,
+    'spread': _spread,
+}
+
+
+def _simulate_placement(strategy, disks, trace):
+    """
+    Replay the allocations of trace on empty disks using strategy
+    :param strategy: placement strategy from PLACEMENT_STRATEGIES
+    :param disks: list of dicts with the keys name, type and size in bytes
+    :param trace: list of dicts with the keys disktype (HDD or SSD), mode and size in GiB
+    :return: dict with the number of allocations placed and failed, the utilization (used / total space),
+             the fragmentation (1 - biggest free space / total free space) and the imbalance
+             (difference between the most and the least used disk, as a fraction of their size)
+    """
+    disks = [{'path': disk['name'], 'type': disk['type'], 'size': disk['size'], 'used': 0, 'mode': None}
+             for disk in disks]
+    by_path = {disk['path']: disk for disk in disks}
+    placed = failed = 0
+    last_path = None
+    for allocation in trace:
+        disktypes = ['HDD', 'ARCHIVE'] if allocation['disktype'] == 'HDD' else ['SSD', 'NVME']
+        size = allocation['size'] * 1024 ** 3
+        candidates = [{'path': disk['path'], 'free': disk['size'] - disk['used'], 'zdb': disk['path'] if disk['mode'] else None}
+                      for disk in disks
+                      if disk['type'] in disktypes and disk['mode'] in (None, allocation['mode'])
+                      and disk['size'] - disk['used'] > size]
+        if not candidates:
+            failed += 1
+            continue
+        candidate = strategy(candidates, last_path)
+        disk = by_path[candidate['path']]
+        disk['used'] += size
+        disk['mode'] = allocation['mode']
+        last_path = candidate['path']
+        placed += 1
+
+    total = sum(disk['size'] for disk in disks)
+    used = sum(disk['used'] for disk in disks)
+    free = [disk['size'] - disk['used'] for disk in disks]
+    usage = [disk['used'] / disk['size'] for disk in disks if disk['size']]
+    return {
+        'placed': placed,
+        'failed': failed,
+        'utilization': used / total if total else 0,
+        'fragmentation': 1 - max(free) / sum(free) if sum(free) else 0,
+        'imbalance': max(usage) - min(usage) if usage else 0,
+    }
@@ -1,9 +1,11 @@
 from unittest.mock import MagicMock, patch
 import os
+import time
 
 import pytest
 
-from node import Node, NODE_CLIENT
+from node import Node, NODE_CLIENT, ZDB_TEMPLATE_UID, CAPACITY_REFRESH_INTERVAL, PLACEMENT_STRATEGIES, NoNamespaceAvailability, TasksError
+from node import _mounted_disks
 from zerorobot.template.state import StateCheckError
 
 from JumpScale9Zrobot.test.utils import ZrobotBaseTest, mock_decorator
@@ -85,9 +87,11 @@ class TestNodeTemplate(ZrobotBaseTest):
         node = Node(name='node')
         container = MagicMock()
         node.api.services.find = MagicMock(return_value=[container])
+        node._wait_all = MagicMock()
         node._start_all_containers()
 
         container.schedule_action.assert_called_once_with('start')
+        assert node._wait_all.called
 
     def test_stop_all_containers(self):
         """
@@ -115,6 +119,257 @@ class TestNodeTemplate(ZrobotBaseTest):
         node._wait_all([task], timeout=30, die=True)
         task.wait.assert_called_with(timeout=30, die=True)
 
+    def test_wait_all_results(self):
+        """
+        Test node _wait_all returns the results in the same order as the tasks
+        """
+        node = Node(name='node')
+        tasks = [MagicMock(state='ok', result=i) for i in range(5)]
+        assert node._wait_all(tasks) == [0, 1, 2, 3, 4]
+
+    def test_wait_all_partial_results(self):
+        """
+        Test node _wait_all collects the results of the successful tasks when some tasks fail
+        """
+        node = Node(name='node')
+        ok_task = MagicMock(state='ok', result='result')
+        error_task = MagicMock(state='error', result=None)
+        error_task.eco.errormessage = 'error'
+        raising_task = MagicMock()
+        raising_task.wait.side_effect = TimeoutError()
+
+        assert node._wait_all([ok_task, error_task, raising_task]) == ['result', None, None]
+
+    def test_wait_all_die(self):
+        """
+        Test node _wait_all raises TasksError with the errors of every failed task if die is True
+        """
+        node = Node(name='node')
+        ok_task = MagicMock(state='ok', result='result')
+        error_task = MagicMock(state='error', result=None)
+        error_task.eco.errormessage = 'error'
+
+        with pytest.raises(TasksError) as err:
+            node._wait_all([ok_task, error_task], die=True)
+        assert err.value.results == ['result', None]
+        assert list(err.value.errors.keys()) == [error_task]
+
+    def test_refresh_capacity(self):
+        """
+        Test node _refresh_capacity indexes the zerodbs and the disks that are not used
+        """
+        node = Node(name='node')
+        zdb = MagicMock(data={'path': '/mnt/sda', 'mode': 'user', 'namespaces': [{'name': 'ns'}]})
+        zdb.name = 'zdb1'
+        node.api.services.find = MagicMock(return_value=[zdb])
+        node._wait_all = MagicMock(return_value=[{'free': 10, 'type': 'HDD', 'path': '/mnt/sda'}])
+        disk = MagicMock(size=100)
+        disk.name = 'sdb'
+        disk.type.value = 'SSD'
+        node.node_sal.disks.list.return_value = [disk]
+
+        node._refresh_capacity([{'mountpoint': '/mnt/sda', 'disk': 'sda'}, {'mountpoint': '/mnt/sdb', 'disk': 'sdb'}])
+
+        assert node._capacity == {
+            'zdbs': {'zdb1': {'free': 10, 'size': None, 'type': 'HDD', 'mode': 'user', 'path': '/mnt/sda'}},
+            'disks': {'/mnt/sdb': {'name': 'sdb', 'size': 100, 'type': 'SSD', 'mountpoint': '/mnt/sdb'}},
+        }
+
+    def test_monitor_refresh_capacity_throttled(self):
+        """
+        Test _monitor only refreshes the capacity when the mounted disks changed or the index is too old
+        """
+        node = Node(name='node', data={'uptime': 10.0})
+        node.state.set('actions', 'install', 'ok')
+        node.node_sal.uptime = MagicMock(return_value=40.0)
+        mounted = [{'mountpoint': '/mnt/sda', 'disk': 'sda'}]
+        node.node_sal.zerodbs.partition_and_mount_disks.return_value = mounted
+        node._capacity = {'zdbs': {}, 'disks': {}}
+        node._capacity_refreshed = (_mounted_disks(mounted), time.time())
+        node._refresh_capacity = MagicMock()
+
+        node._monitor()
+        assert not node._refresh_capacity.called
+
+        mounted = mounted + [{'mountpoint': '/mnt/sdb', 'disk': 'sdb'}]
+        node.node_sal.zerodbs.partition_and_mount_disks.return_value = mounted
+        node._monitor()
+        node._refresh_capacity.assert_called_once_with(mounted)
+
+        node._refresh_capacity.reset_mock()
+        node._capacity_refreshed = (_mounted_disks(mounted), time.time() - CAPACITY_REFRESH_INTERVAL - 1)
+        node._monitor()
+        node._refresh_capacity.assert_called_once_with(mounted)
+
+    def test_create_zdb_namespace_free_disk(self):
+        """
+        Test node create_zdb_namespace deploys a zerodb on a free disk
+        """
+        node = Node(name='node')
+        node._capacity = {
+            'zdbs': {},
+            'disks': {'/mnt/sda': {'name': 'sda', 'size': 100 * 1024 ** 3, 'type': 'HDD', 'mountpoint': '/mnt/sda'}},
+        }
+        node._create_zdb = MagicMock(return_value='zdb_node_sda')
+
+        assert node.create_zdb_namespace('HDD', 'user', 'password', False, 10, name='ns') == ('zdb_node_sda', 'ns')
+        node._create_zdb.assert_called_once_with('ns', 'sda', '/mnt/sda', 'user', 'password', False, 10)
+        assert node._capacity['disks'] == {}
+        assert node._capacity['zdbs']['zdb_node_sda']['path'] == '/mnt/sda'
+        assert node._reservations == {}
+
+    def test_create_zdb_namespace_free_disk_fails(self):
+        """
+        Test node create_zdb_namespace gives the disk back if the zerodb creation fails
+        """
+        node = Node(name='node')
+        disk = {'name': 'sda', 'size': 100 * 1024 ** 3, 'type': 'HDD', 'mountpoint': '/mnt/sda'}
+        node._capacity = {'zdbs': {}, 'disks': {'/mnt/sda': disk}}
+        node._create_zdb = MagicMock(side_effect=RuntimeError)
+
+        with pytest.raises(RuntimeError):
+            node._place_zdb_namespace('ns', ['HDD'], 'user', 'password', False, 10)
+        assert node._capacity['disks'] == {'/mnt/sda': disk}
+        assert node._reservations == {}
+
+    def test_create_zdb_namespace_existing_zdb(self):
+        """
+        Test node create_zdb_namespace creates the namespace on the zerodb with the most space available
+        """
+        node = Node(name='node')
+        node._capacity = {
+            'disks': {},
+            'zdbs': {
+                'zdb1': {'free': 20 * 1024 ** 3, 'size': 100 * 1024 ** 3, 'type': 'HDD', 'mode': 'user', 'path': '/mnt/sda'},
+                'zdb2': {'free': 50 * 1024 ** 3, 'size': 100 * 1024 ** 3, 'type': 'HDD', 'mode': 'user', 'path': '/mnt/sdb'},
+                'zdb3': {'free': 80 * 1024 ** 3, 'size': 100 * 1024 ** 3, 'type': 'SSD', 'mode': 'user', 'path': '/mnt/sdc'},
+            },
+        }
+        zdb = MagicMock(data={'namespaces': []})
+        node.api.services.get = MagicMock(return_value=zdb)
+
+        assert node.create_zdb_namespace('HDD', 'user', 'password', False, 10, name='ns') == ('zdb2', 'ns')
+        node.api.services.get.assert_called_with(template_uid=ZDB_TEMPLATE_UID, name='zdb2')
+        zdb.schedule_action.assert_called_once_with(
+            'namespace_create', {'name': 'ns', 'size': 10, 'password': 'password', 'public': False})
+        assert node._reservations == {}
+
+    def test_create_zdb_namespace_reserved_space(self):
+        """
+        Test node create_zdb_namespace takes the size of the existing namespaces and the namespaces being created into account
+        """
+        node = Node(name='node')
+        node._capacity = {
+            'disks': {},
+            'zdbs': {
+                'zdb1': {'free': 90 * 1024 ** 3, 'size': 100 * 1024 ** 3, 'type': 'HDD', 'mode': 'user', 'path': '/mnt/sda'},
+                'zdb2': {'free': 50 * 1024 ** 3, 'size': 100 * 1024 ** 3, 'type': 'HDD', 'mode': 'user', 'path': '/mnt/sdb'},
+            },
+        }
+        zdb1 = MagicMock(data={'namespaces': [{'name': 'ns1', 'size': 40}]})
+        zdb2 = MagicMock(data={'namespaces': []})
+        node.api.services.get = MagicMock(side_effect=lambda template_uid, name: zdb1 if name == 'zdb1' else zdb2)
+
+        # zdb1 has 60GiB not reserved, zdb2 50GiB
+        assert node.create_zdb_namespace('HDD', 'user', 'password', False, 10, name='ns') == ('zdb1', 'ns')
+
+        # a namespace of 20GiB is being created on zdb1
+        node._reservations = {'/mnt/sda': {'ns2': 20 * 1024 ** 3}}
+        assert node.create_zdb_namespace('HDD', 'user', 'password', False, 10, name='ns3') == ('zdb2', 'ns3')
+
+    def test_create_zdb_namespace_strategies(self):
+        """
+        Test node create_zdb_namespace uses the placement strategy of the node data
+        """
+        expected = {'worstFit': '/mnt/sdc', 'bestFit': '/mnt/sda', 'pack': '/mnt/sda', 'spread': '/mnt/sdb'}
+        for strategy, path in expected.items():
+            node = Node(name='node', data={'placementStrategy': strategy})
+            node._capacity = {
+                'disks': {'/mnt/sdc': {'name': 'sdc', 'size': 100 * 1024 ** 3, 'type': 'HDD', 'mountpoint': '/mnt/sdc'}},
+                'zdbs': {
+                    'zdb1': {'free': 20 * 1024 ** 3, 'size': 100 * 1024 ** 3, 'type': 'HDD', 'mode': 'user', 'path': '/mnt/sda'},
+                    'zdb2': {'free': 50 * 1024 ** 3, 'size': 100 * 1024 ** 3, 'type': 'HDD', 'mode': 'user', 'path': '/mnt/sdb'},
+                },
+            }
+            node._last_placement = '/mnt/sda'
+            node._create_zdb = MagicMock(return_value='zdb3')
+            node.api.services.get = MagicMock(return_value=MagicMock(data={'namespaces': []}))
+            node.create_zdb_namespace('HDD', 'user', 'password', False, 10, name='ns')
+            assert node._last_placement == path, strategy
+
+    def test_simulate_placement(self):
+        """
+        Test node simulate_placement reports every strategy
+        """
+        node = Node(name='node')
+        disks = [
+            {'name': 'sda', 'type': 'HDD', 'size': 100 * 1024 ** 3},
+            {'name': 'sdb', 'type': 'HDD', 'size': 100 * 1024 ** 3},
+        ]
+        trace = [{'disktype': 'HDD', 'mode': 'user', 'size': 10}] * 4 + [{'disktype': 'SSD', 'mode': 'user', 'size': 10}]
+        reports = node.simulate_placement(trace=trace, disks=disks)
+
+        assert set(reports.keys()) == set(PLACEMENT_STRATEGIES.keys())
+        for report in reports.values():
+            assert report['placed'] == 4
+            assert report['failed'] == 1
+            assert report['utilization'] == 0.2
+        assert reports['spread']['imbalance'] == 0
+        assert reports['pack']['imbalance'] == 0.4
+
+    def test_create_zdb_namespace_no_space(self):
+        """
+        Test node create_zdb_namespace refreshes the capacity once before giving up
+        """
+        node = Node(name='node')
+        node._capacity = {'disks': {}, 'zdbs': {}}
+        node._refresh_capacity = MagicMock()
+
+        with pytest.raises(NoNamespaceAvailability):
+            node.create_zdb_namespace('HDD', 'user', 'password', False, 10)
+        node._refresh_capacity.assert_called_once_with()
+
+    def test_register_unchanged(self):
+        """
+        Test _register only pushes the capacity to the directory when it changed
+        """
+        node = Node(name='node')
+        node.state.set('actions', 'install', 'ok')
+        node.api.services.find = MagicMock(return_value=[])
+        capacity = node.node_sal.capacity
+        capacity.total_report.return_value = {'cru': 4}
+        capacity.reality_report.return_value = {'cru': 1}
+        node._register()
+        node._register()
+
+        capacity.register.assert_called_once_with()
+        capacity.update_reality.assert_called_once_with()
+        capacity.update_reserved.assert_called_once_with(vms=[], vdisks=[], gateways=[])
+
+        capacity.reality_report.return_value = {'cru': 2}
+        node._register()
+        capacity.register.assert_called_once_with()
+        assert capacity.update_reality.call_count == 2
+        capacity.update_reserved.assert_called_once_with(vms=[], vdisks=[], gateways=[])
+
+    def test_register_heartbeat(self):
+        """
+        Test _register pushes the capacity again when the last push is too old
+        """
+        node = Node(name='node')
+        node.state.set('actions', 'install', 'ok')
+        node.api.services.find = MagicMock(return_value=[])
+        capacity = node.node_sal.capacity
+        capacity.total_report.return_value = {'cru': 4}
+        capacity.reality_report.return_value = {'cru': 1}
+        node._register()
+        node._capacity_pushes = {kind: (digest, 0) for kind, (digest, _) in node._capacity_pushes.items()}
+        node._register()
+
+        assert capacity.register.call_count == 2
+        assert capacity.update_reality.call_count == 2
+        assert capacity.update_reserved.call_count == 2
+
     def test_reboot_node(self):
         """
         Test node reboot if node already running
@@ -1,11 +1,12 @@
 from js9 import j
 import copy
 import netaddr
+from zerorobot.service_collection import ServiceNotFoundError
 from zerorobot.template.base import TemplateBase
 
 NODE_CLIENT = 'local'
 GATEWAY_TEMPLATE_UID = 'github.com/zero-os/0-templates/gateway/0.0.1'
-
+ZT_TEMPLATE_UID = 'github.com/zero-os/0-templates/zerotier_client/0.0.1'
 
 class PublicGateway(TemplateBase):
     version = '0.0.1'
@@ -48,35 +49,82 @@ class PublicGateway(TemplateBase):
 
     def install(self):
         self.logger.info('Install public gateway {}'.format(self.name))
-        gw_service = self._gateway_service
-        portforwards = self.data.get('portforwards')
-        for portforward in portforwards:
+        changes = []
+        for portforward in self.data.get('portforwards'):
             fwd = copy.deepcopy(portforward)
             fwd['srcnetwork'] = 'public'
             fwd['name'] = self._prefix_name(portforward['name'])
-            gw_service.schedule_action('add_portforward', args={'forward': fwd}).wait(die=True)
+            changes.append({'action': 'add_portforward', 'args': {'forward': fwd}})
 
-        proxies = self.data.get('httpproxies')
-        for proxy in proxies:
+        for proxy in self.data.get('httpproxies'):
             p = copy.deepcopy(proxy)
             p['name'] = self._prefix_name(proxy['name'])
-            gw_service.schedule_action('add_http_proxy', args={'proxy': p}).wait(die=True)
+            changes.append({'action': 'add_http_proxy', 'args': {'proxy': p}})
+
+        # either all the forwards and proxies are installed or none of them
+        self._apply_gateway_changes(changes, atomic=True)
+
+    def _apply_gateway_changes(self, changes, atomic=False):
+        """
+        Apply changes to the gateway in one batch
+        :param changes: list of changes, see the apply_changes action of the gateway
+        :param atomic: if True, either all the changes are applied or none of them and the error is raised.
+                       If False, each change is applied unless it is not valid
+        :return: if not atomic, list of {'action': action, 'error': error} for each change
+        :raises RuntimeError: if some of the changes failed
+        """
+        if not changes:
+            return []
+        args = {'changes': changes, 'atomic': atomic}
+        task = self._gateway_service.schedule_action('apply_changes', args=args).wait(die=True)
+        if atomic:
+            return
+        results = task.result
+        errors = ['{}: {}'.format(result['action'], result['error']) for result in results if result['error']]
+        if errors:
+            raise RuntimeError('{} of {} changes failed on the gateway: {}'.format(
+                len(errors), len(changes), '; '.join(errors)))
+        return results
+
+    def _change_gateway(self, action, args):
+        """
+        Apply one change to the gateway.
+        When the gateway runs in this robot the change is queued on it, so the changes made by all the
+        public gateways within a second reconfigure the gateway once. Otherwise the gateway action is scheduled
+        :param action: name of the gateway action doing the change
+        :param args: arguments of the action
+        """
+        gw_service = self._gateway_service
+        if hasattr(gw_service, 'queue_changes'):
+            gw_service.queue_changes([{'action': action, 'args': args}])
+        else:
+            gw_service.schedule_action(action, args=args).wait(die=True)
 
     def get_zt_member(self, identity):
         address = identity.split(':')[0]
         for network in self._gateway_service.info()['networks']:
             if network['type'] == 'zerotier':
-                client = j.clients.zerotier.get(network['ztClient'])
-                ztnetwork = client.network_get(network['id'])
-                return ztnetwork.member_get(address=address).data
+                return self._get_zt_member(network['ztClient'], network['id'], address).data
+
+    def _get_zt_member(self, client_name, network_id, address, refresh=False):
+        """
+        Get a member of a zerotier network from the members cache of the zerotier_client service of the client,
+        shared by all the services of this robot. Without such a service the member is asked to zerotier directly
+        """
+        try:
+            zt_service = self.api.services.get(template_uid=ZT_TEMPLATE_UID, name=client_name)
+        except ServiceNotFoundError:
+            zt_service = None
+        if not hasattr(zt_service, 'network_member'):
+            return j.clients.zerotier.get(client_name).network_get(network_id).member_get(address=address)
+        return zt_service.network_member(network_id, address, refresh=refresh)
 
     def add_portforward(self, forward):
         self.logger.info('Add portforward {}'.format(forward['name']))
-        gw_service = self._gateway_service
         fwd = copy.deepcopy(forward)
         fwd['srcnetwork'] = 'public'
         fwd['name'] = self._prefix_name(forward['name'])
-        gw_service.schedule_action('add_portforward', args={'forward': fwd}).wait(die=True)
+        self._change_gateway('add_portforward', {'forward': fwd})
         self.data['portforwards'].append(forward)
 
     def _prefix_name(self, name):
@@ -85,7 +133,7 @@ class PublicGateway(TemplateBase):
     def remove_portforward(self, name):
         self.logger.info('Remove portforward {}'.format(name))
         pname = self._prefix_name(name)
-        self._gateway_service.schedule_action('remove_portforward', args={'name': pname}).wait(die=True)
+        self._change_gateway('remove_portforward', {'name': pname})
         for forward in self.data['portforwards']:
             if forward['name'] == name:
                 self.data['portforwards'].remove(forward)
@@ -95,13 +143,13 @@ class PublicGateway(TemplateBase):
         self.logger.info('Add http proxy {}'.format(proxy['name']))
         gwproxy = copy.deepcopy(proxy)
         gwproxy['name'] = self._prefix_name(proxy['name'])
-        self._gateway_service.schedule_action('add_http_proxy', args={'proxy': gwproxy}).wait(die=True)
+        self._change_gateway('add_http_proxy', {'proxy': gwproxy})
         self.data['httpproxies'].append(proxy)
 
     def remove_http_proxy(self, name):
         self.logger.info('Remove http proxy {}'.format(name))
         pname = self._prefix_name(name)
-        self._gateway_service.schedule_action('remove_http_proxy', args={'name': pname}).wait(die=True)
+        self._change_gateway('remove_http_proxy', {'name': pname})
         for proxy in self.data['httpproxies']:
             if proxy['name'] == name:
                 self.data['httpproxies'].remove(proxy)
@@ -126,15 +174,16 @@ class PublicGateway(TemplateBase):
         return data
 
     def uninstall(self):
-        gw_service = self._gateway_service
         self.logger.info('Uninstall publicservice {}'.format(self.name))
+        changes = []
         for portforward in self.data['portforwards']:
             name = self._prefix_name(portforward['name'])
-            gw_service.schedule_action('remove_portforward', args={'name': name}).wait(die=True)
+            changes.append({'action': 'remove_portforward', 'args': {'name': name}})
 
-        proxies = self.data.get('httpproxies')
-        for proxy in proxies:
+        for proxy in self.data.get('httpproxies'):
             name = self._prefix_name(proxy['name'])
-            gw_service.schedule_action('remove_http_proxy', args={'name': name}).wait(die=True)
+            changes.append({'action': 'remove_http_proxy', 'args': {'name': name}})
+
+        self._apply_gateway_changes(changes)
 
 
@@ -4,7 +4,7 @@ import os
 import copy
 import netaddr
 
-from public_gateway import PublicGateway
+from public_gateway import PublicGateway, GATEWAY_TEMPLATE_UID, ZT_TEMPLATE_UID
 from JumpScale9Zrobot.test.utils import ZrobotBaseTest
 
 class AlwaysTrue:
@@ -31,7 +31,33 @@ class TestPublicGatewayTemplate(ZrobotBaseTest):
 
     def test_install(self):
         self.service.install()
-        assert self.gwservice.schedule_action.call_count == 2
+        self.gwservice.schedule_action.assert_called_once_with('apply_changes', args=AlwaysTrue())
+        assert self.gwservice.schedule_action.call_args[1]['args']['atomic']
+        changes = self.gwservice.schedule_action.call_args[1]['args']['changes']
+        assert [change['action'] for change in changes] == ['add_portforward', 'add_http_proxy']
+        assert changes[0]['args']['forward']['name'] == '{}_ssh'.format(self.service.guid)
+        assert changes[0]['args']['forward']['srcnetwork'] == 'public'
+
+    def test_install_errors(self):
+        self.gwservice.schedule_action.return_value.wait.side_effect = ValueError('A forward with the same name exists')
+        with pytest.raises(ValueError, message='install should fail if some of the changes failed'):
+            self.service.install()
+
+    def test_uninstall_errors(self):
+        task = self.gwservice.schedule_action.return_value.wait.return_value
+        task.result = [{'action': 'remove_portforward', 'error': 'Network with name public doesn\'t exist'},
+                       {'action': 'remove_http_proxy', 'error': None}]
+        with pytest.raises(RuntimeError, message='uninstall should fail if some of the changes failed'):
+            self.service.uninstall()
+
+    def test_uninstall(self):
+        task = self.gwservice.schedule_action.return_value.wait.return_value
+        task.result = [{'action': 'remove_portforward', 'error': None}, {'action': 'remove_http_proxy', 'error': None}]
+        self.service.uninstall()
+        self.gwservice.schedule_action.assert_called_once_with('apply_changes', args=AlwaysTrue())
+        assert not self.gwservice.schedule_action.call_args[1]['args']['atomic']
+        changes = self.gwservice.schedule_action.call_args[1]['args']['changes']
+        assert [change['action'] for change in changes] == ['remove_portforward', 'remove_http_proxy']
 
     def test_info(self):
         info = self.service.info()
@@ -39,6 +65,17 @@ class TestPublicGatewayTemplate(ZrobotBaseTest):
         assert info['portforwards'] == self.valid_data['portforwards']
         assert info['httpproxies'] == self.valid_data['httpproxies']
 
+    def test_get_zt_member(self):
+        self.gwservice.info.return_value = {'networks': [{'type': 'zerotier', 'ztClient': 'zt', 'id': 'network'}]}
+        zt_service = MagicMock()
+        zt_service.network_member.return_value.data = 'data1'
+        services = {GATEWAY_TEMPLATE_UID: self.gwservice, ZT_TEMPLATE_UID: zt_service}
+        self.service.api.services.get = MagicMock(side_effect=lambda template_uid, name: services[template_uid])
+
+        assert self.service.get_zt_member('member1:identity') == 'data1'
+        self.service.api.services.get.assert_called_with(template_uid=ZT_TEMPLATE_UID, name='zt')
+        zt_service.network_member.assert_called_once_with('network', 'member1', refresh=False)
+
     def list_name_contains(self, datalist, name):
         for item in datalist:
             if item['name'] == name:
@@ -108,23 +145,31 @@ class TestPublicGatewayTemplate(ZrobotBaseTest):
     def test_add_proxy(self):
         proxy = {'name': 'myproxy', 'host': 'example.com', 'destinations': ['http://192.168.1.1:8080']}
         self.service.add_http_proxy(proxy)
-        self.gwservice.schedule_action.assert_called_once_with('add_http_proxy', args=AlwaysTrue())
+        self.gwservice.queue_changes.assert_called_once_with([{'action': 'add_http_proxy', 'args': AlwaysTrue()}])
         assert self.list_name_contains(self.service.data['httpproxies'], 'myproxy')
 
     def test_remove_proxy(self):
         self.test_add_proxy()
         self.service.remove_http_proxy('myproxy')
-        self.gwservice.schedule_action.assert_called_with('remove_http_proxy', args=AlwaysTrue())
+        self.gwservice.queue_changes.assert_called_with([{'action': 'remove_http_proxy', 'args': AlwaysTrue()}])
         assert not self.list_name_contains(self.service.data['httpproxies'], 'myproxy')
 
     def test_add_portforward(self):
         fwd = {'name': 'forward', 'srcport': 34, 'dstip': '192.168.1.228', 'dstport': 80}
         self.service.add_portforward(fwd)
-        self.gwservice.schedule_action.assert_called_once_with('add_portforward', args=AlwaysTrue())
+        self.gwservice.queue_changes.assert_called_once_with([{'action': 'add_portforward', 'args': AlwaysTrue()}])
         assert self.list_name_contains(self.service.data['portforwards'], 'forward')
 
     def test_remove_forward(self):
         self.test_add_portforward()
         self.service.remove_portforward('forward')
-        self.gwservice.schedule_action.assert_called_with('remove_portforward', args=AlwaysTrue())
+        self.gwservice.queue_changes.assert_called_with([{'action': 'remove_portforward', 'args': AlwaysTrue()}])
         assert not self.list_name_contains(self.service.data['portforwards'], 'forward')
+
+    def test_add_portforward_remote_gateway(self):
+        self.gwservice = MagicMock(spec=['schedule_action'])
+        self.service.api.services.get = MagicMock(return_value=self.gwservice)
+        fwd = {'name': 'forward', 'srcport': 34, 'dstip': '192.168.1.228', 'dstport': 80}
+        self.service.add_portforward(fwd)
+        self.gwservice.schedule_action.assert_called_once_with('add_portforward', args=AlwaysTrue())
+        assert self.list_name_contains(self.service.data['portforwards'], 'forward')
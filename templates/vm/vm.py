@@ -1,10 +1,36 @@
+import time
+
+import gevent
+from gevent.lock import BoundedSemaphore
 from js9 import j
+from zerorobot.service_collection import ServiceNotFoundError
 from zerorobot.template.base import TemplateBase
 from zerorobot.template.state import StateCheckError
 import copy
 
 NODE_CLIENT = 'local'
 VDISK_TEMPLATE_UID = 'github.com/zero-os/0-templates/vdisk/0.0.1'
+ZT_TEMPLATE_UID = 'github.com/zero-os/0-templates/zerotier_client/0.0.1'
+VM_STATES_TTL = 30  # seconds the listing of the vms state is shared by the monitors, same as the monitor interval
+VDISK_URL_TIMEOUT = 60  # seconds to resolve the urls of all the vdisks of a vm
+VM_INFO_TTL = 5 * 60  # seconds the vnc port and zerotier ips of the info snapshot are reused
+ZT_IP_TIMEOUT = 10  # default seconds to wait for the zerotier ip of a nic
+
+_vm_states = {'states': None, 'listed': 0}
+_vm_states_lock = BoundedSemaphore()
+
+
+def _list_vm_states(node_sal):
+    """
+    Get the state of all the vms on the node, keyed by vm name.
+    The node is queried at most once every VM_STATES_TTL seconds and the listing is shared
+    by the monitors of all the vm services of this process.
+    """
+    with _vm_states_lock:
+        if _vm_states['states'] is None or time.time() - _vm_states['listed'] > VM_STATES_TTL:
+            _vm_states['states'] = {vm['name']: vm['state'] for vm in node_sal.client.kvm.list()}
+            _vm_states['listed'] = time.time()
+        return _vm_states['states']
 
 
 class Vm(TemplateBase):
@@ -17,6 +43,10 @@ class Vm(TemplateBase):
 
         self.add_delete_callback(self.uninstall)
         self.recurring_action('_monitor', 30)  # every 30 seconds
+        self._vm_sal_cache = (None, None)  # (node client, vm sal), reset by _data_changed
+        self._vdisk_urls = {}  # vdisk name -> ((vdisk guid, zerodb, namespace), private url)
+        self._info = None  # snapshot of the vm info, see info
+        self._info_refreshed = 0
 
     def validate(self):
         if not (self.data['flist'] or self.data['ipxeUrl']):
@@ -28,9 +58,27 @@ class Vm(TemplateBase):
 
     @property
     def _vm_sal(self):
-        data = self.data.copy()
-        data['name'] = self.name
-        return self._node_sal.primitives.from_dict('vm', data)
+        """
+        vm sal, only rebuilt when js9 gives another client for the node or the service data was changed
+        """
+        node_sal = self._node_sal
+        cached_client, vm_sal = self._vm_sal_cache
+        if cached_client is not node_sal.client:
+            data = self.data.copy()
+            data['name'] = self.name
+            vm_sal = node_sal.primitives.from_dict('vm', data)
+            self._vm_sal_cache = (node_sal.client, vm_sal)
+        return vm_sal
+
+    def _data_changed(self):
+        """
+        Must be called after changing the service data, so the vm sal is rebuilt from it
+        """
+        self._vm_sal_cache = (None, None)
+
+    def update_data(self, data):
+        super().update_data(data)
+        self._data_changed()
 
     @property
     def _node_sal(self):
@@ -44,18 +92,23 @@ class Vm(TemplateBase):
         self.state.check('actions', 'install', 'ok')
         self.state.check('actions', 'start', 'ok')
 
-        if not self._vm_sal.is_running():
+        # only query this vm directly if the node wide listing doesn't show it running
+        status = _list_vm_states(self._node_sal).get(self.name, 'halted')
+        if status != 'running' and self._vm_sal.is_running():
+            status = 'running'
+        if status != 'running':
             self.state.delete('status', 'running')
 
             for disk in self.data['disks']:
                 vdisk = self.api.services.get(template_uid=VDISK_TEMPLATE_UID, name=disk['name'])
                 vdisk.state.check('status', 'running', 'ok')  # Cannot start vm until vdisks are running
 
-            self._update_vdisk_url()
+            self._update_vdisk_url(refresh=True)
             self._vm_sal.deploy()
 
             if self._vm_sal.is_running():
                 self.state.set('status', 'running', 'ok')
+            self._info = None
         else:
             self.state.set('status', 'running', 'ok')
 
@@ -67,25 +120,73 @@ class Vm(TemplateBase):
         except StateCheckError:
             pass
 
+        if self._info is not None:
+            # only the status of the snapshot is kept up to date by the monitor
+            self._info['status'] = status
+
     def update_ipxeurl(self, url):
         self.data['ipxeUrl'] = url
+        self._data_changed()
 
     def generate_identity(self):
         self.data['ztIdentity'] = self._node_sal.generate_zerotier_identity()
+        self._data_changed()
         return self.data['ztIdentity']
 
-    def _update_vdisk_url(self):
+    def _update_vdisk_url(self, refresh=False):
+        """
+        Set the private url of the vdisks of the vm.
+        The urls are resolved in parallel within VDISK_URL_TIMEOUT, and are only resolved again
+        when the zerodb or the namespace of the vdisk changed or if refresh is True.
+        The cached urls don't follow a redeploy of the zerodb on another address or port,
+        so the actions deploying the vm always refresh them
+        :param refresh: resolve the urls of all the vdisks
+        """
+        tasks = []
         for disk in self.data['disks']:
             vdisk = self.api.services.get(template_uid=VDISK_TEMPLATE_UID, name=disk['name'])
-            disk['url'] = vdisk.schedule_action('private_url').wait(die=True).result
+            backend = (vdisk.guid, vdisk.data['zerodb'], vdisk.data['nsName'])
+            cached_backend, url = self._vdisk_urls.get(disk['name'], (None, None))
+            if not refresh and cached_backend == backend:
+                self._set_vdisk_url(disk, url)
+            else:
+                tasks.append((disk, backend, vdisk.schedule_action('private_url')))
+
+        def wait(task):
+            try:
+                return task.wait(timeout=VDISK_URL_TIMEOUT, die=True).result, None
+            except Exception as err:
+                return None, err
+
+        # one deadline for all the vdisks, they are waited for concurrently
+        greenlets = [gevent.spawn(wait, task) for _, _, task in tasks]
+        gevent.joinall(greenlets, timeout=VDISK_URL_TIMEOUT)
+        gevent.killall([greenlet for greenlet in greenlets if not greenlet.ready()], block=False)
+
+        for (disk, backend, _), greenlet in zip(tasks, greenlets):
+            if not greenlet.ready():
+                raise TimeoutError('vdisk {} did not return its url within {} seconds'.format(
+                    disk['name'], VDISK_URL_TIMEOUT))
+            url, err = greenlet.value
+            if err is not None:
+                raise err
+            self._set_vdisk_url(disk, url)
+            self._vdisk_urls[disk['name']] = (backend, url)
+
+    def _set_vdisk_url(self, disk, url):
+        if disk.get('url') != url:
+            disk['url'] = url
+            self._data_changed()
 
     def install(self):
         self.logger.info('Installing vm %s' % self.name)
-        self._update_vdisk_url()
+        self._update_vdisk_url(refresh=True)
         vm_sal = self._vm_sal
         vm_sal.deploy()
+        self._info = None
         self.data['uuid'] = vm_sal.uuid
         self.data['ztIdentity'] = vm_sal.zt_identity
+        self._data_changed()
 
         self.state.set('actions', 'install', 'ok')
         self.state.set('actions', 'start', 'ok')
@@ -97,6 +198,7 @@ class Vm(TemplateBase):
     def uninstall(self):
         self.logger.info('Uninstalling vm %s' % self.name)
         self._vm_sal.destroy()
+        self._info = None
         self.state.delete('actions', 'install')
         self.state.delete('actions', 'start')
         self.state.delete('status', 'running')
@@ -108,6 +210,7 @@ class Vm(TemplateBase):
             self._vm_sal.shutdown()
         else:
             self._vm_sal.destroy()
+        self._info = None
         self.state.delete('status', 'running')
         self.state.delete('actions', 'start')
 
@@ -115,22 +218,25 @@ class Vm(TemplateBase):
         self.logger.info('Pausing vm %s' % self.name)
         self.state.check('status', 'running', 'ok')
         self._vm_sal.pause()
+        self._info = None
         self.state.delete('status', 'running')
         self.state.set('actions', 'pause', 'ok')
 
     def start(self):
         self.logger.info('Starting vm {}'.format(self.name))
         self.state.set('actions', 'install', 'ok')
-        self._update_vdisk_url()
+        self._update_vdisk_url(refresh=True)
         self._vm_sal.deploy()
+        self._info = None
         self.state.set('actions', 'start', 'ok')
         self.state.set('status', 'running', 'ok')
 
     def resume(self):
         self.logger.info('Resuming vm %s' % self.name)
         self.state.check('actions', 'pause', 'ok')
-        self._update_vdisk_url()
+        self._update_vdisk_url(refresh=True)
         self._vm_sal.resume()
+        self._info = None
         self.state.delete('actions', 'pause')
         self.state.set('status', 'running', 'ok')
         self.state.set('actions', 'start', 'ok')
@@ -138,45 +244,78 @@ class Vm(TemplateBase):
     def reboot(self):
         self.logger.info('Rebooting vm %s' % self.name)
         self.state.check('actions', 'install', 'ok')
-        self._update_vdisk_url()
+        self._update_vdisk_url(refresh=True)
         self._vm_sal.reboot()
+        self._info = None
         self.state.set('status', 'rebooting', 'ok')
 
     def reset(self):
         self.logger.info('Resetting vm %s' % self.name)
         self.state.check('actions', 'install', 'ok')
         self._vm_sal.reset()
+        self._info = None
 
     def enable_vnc(self):
         self.logger.info('Enable vnc for vm %s' % self.name)
         self.state.check('actions', 'install', 'ok')
         self._vm_sal.enable_vnc()
+        self._info = None
+
+    def info(self, timeout=None, refresh=False):
+        """
+        Get the info of the vm from a snapshot.
+        The status of the snapshot is kept up to date by the monitor from the node wide vms listing,
+        the rest of the snapshot is taken from the vm again after VM_INFO_TTL seconds
+        :param timeout: time to wait for the zerotier ips when the info is refreshed, ZT_IP_TIMEOUT if None
+        :param refresh: get the live info of the vm instead of the snapshot
+        """
+        if refresh or self._info is None or time.time() - self._info_refreshed > VM_INFO_TTL:
+            self._refresh_info(timeout, refresh)
+        return copy.deepcopy(self._info)
 
-    def info(self, timeout=None):
-        self._update_vdisk_url()
+    def _refresh_info(self, timeout=None, refresh_members=False):
+        if timeout is None:
+            timeout = ZT_IP_TIMEOUT
         info = self._vm_sal.info or {}
         nics = copy.deepcopy(self.data['nics'])
+        listed = set()  # networks already listed again by this refresh
         for nic in nics:
             if nic['type'] == 'zerotier' and nic.get('ztClient') and self.data.get('ztIdentity'):
                 ztAddress = self.data['ztIdentity'].split(':')[0]
-                zclient = j.clients.zerotier.get(nic['ztClient'])
+                network = (nic['ztClient'], nic['id'])
                 try:
-                    network = zclient.network_get(nic['id'])
-                    member = network.member_get(address=ztAddress)
+                    member = self._get_zt_member(nic['ztClient'], nic['id'], ztAddress,
+                                                 refresh_members and network not in listed)
+                    listed.add(network)
                     member.timeout = None
                     nic['ip'] = member.get_private_ip(timeout)
                 except (RuntimeError, ValueError) as e:
                     self.logger.warning('Failed to retreive zt ip: %s', str(e))
 
-        return {
+        self._info = {
             'vnc': info.get('vnc'),
             'status': info.get('state', 'halted'),
-            'disks': self.data['disks'],
+            'disks': copy.deepcopy(self.data['disks']),
             'nics': nics,
             'ztIdentity': self.data['ztIdentity'],
         }
+        self._info_refreshed = time.time()
+
+    def _get_zt_member(self, client_name, network_id, address, refresh=False):
+        """
+        Get a member of a zerotier network from the members cache of the zerotier_client service of the client,
+        shared by all the services of this robot. Without such a service the member is asked to zerotier directly
+        """
+        try:
+            zt_service = self.api.services.get(template_uid=ZT_TEMPLATE_UID, name=client_name)
+        except ServiceNotFoundError:
+            zt_service = None
+        if not hasattr(zt_service, 'network_member'):
+            return j.clients.zerotier.get(client_name).network_get(network_id).member_get(address=address)
+        return zt_service.network_member(network_id, address, refresh=refresh)
 
     def disable_vnc(self):
         self.logger.info('Disable vnc for vm %s' % self.name)
         self.state.check('actions', 'install', 'ok')
         self._vm_sal.disable_vnc()
+        self._info = None
@@ -1,9 +1,11 @@
-from unittest.mock import MagicMock, patch
+from unittest.mock import MagicMock, PropertyMock, call, patch
 import os
 import pytest
+import gevent
 
 from js9 import j
-from vm import Vm, NODE_CLIENT
+from vm import Vm, NODE_CLIENT, VM_INFO_TTL, ZT_TEMPLATE_UID, _vm_states
+from zerorobot.service_collection import ServiceNotFoundError
 from zerorobot.template.state import StateCheckError
 
 from JumpScale9Zrobot.test.utils import ZrobotBaseTest
@@ -33,6 +35,7 @@ class TestVmTemplate(ZrobotBaseTest):
         cls.vnc_port = 5900
 
     def setUp(self):
+        _vm_states['states'] = None
         patch('js9.j.clients.zos.sal.get_node', MagicMock()).start()
 
     def tearDown(self):
@@ -74,6 +77,19 @@ class TestVmTemplate(ZrobotBaseTest):
         vm._node_sal.primitives.from_dict.return_value = vm_sal
         assert vm._vm_sal == vm_sal
 
+    def test_vm_sal_cached(self):
+        """
+        Test the _vm_sal property is only rebuilt when the data changes
+        """
+        vm = Vm('vm', data=self.valid_data)
+        vm._vm_sal
+        vm._vm_sal
+        assert vm._node_sal.primitives.from_dict.call_count == 1
+
+        vm.update_ipxeurl('url')
+        vm._vm_sal
+        assert vm._node_sal.primitives.from_dict.call_count == 2
+
     def test_install_vm(self):
         """
         Test successfully creating a vm
@@ -90,6 +106,54 @@ class TestVmTemplate(ZrobotBaseTest):
         vm.state.check('actions', 'install', 'ok')
         vm.state.check('status', 'running', 'ok')
 
+    def test_update_vdisk_url_timeout(self):
+        """
+        Test _update_vdisk_url raises if the vdisks don't return their url within VDISK_URL_TIMEOUT
+        """
+        patch('vm.VDISK_URL_TIMEOUT', 0.01).start()
+        data = self.valid_data.copy()
+        data['disks'] = [{'name': 'vdisk1', 'url': ''}]
+        vm = Vm('vm', data=data)
+        vdisk = MagicMock(guid='vdisk1', data={'zerodb': 'zdb', 'nsName': 'vdisk1'})
+        vdisk.schedule_action.return_value.wait.side_effect = lambda timeout, die: gevent.sleep(1)
+        vm.api.services.get = MagicMock(return_value=vdisk)
+
+        with pytest.raises(TimeoutError, message='_update_vdisk_url should raise an error if a vdisk url is not returned in time'):
+            vm._update_vdisk_url()
+        assert vm.data['disks'] == [{'name': 'vdisk1', 'url': ''}]
+
+    def test_update_vdisk_url(self):
+        """
+        Test _update_vdisk_url resolves the urls of all the vdisks and caches them
+        """
+        data = self.valid_data.copy()
+        data['disks'] = [{'name': 'vdisk1', 'url': ''}, {'name': 'vdisk2', 'url': ''}]
+        vm = Vm('vm', data=data)
+        vdisks = {}
+        for name in ('vdisk1', 'vdisk2'):
+            vdisks[name] = MagicMock(guid=name, data={'zerodb': 'zdb', 'nsName': name})
+            task = MagicMock()
+            task.wait.return_value.result = 'zdb://%s' % name
+            vdisks[name].schedule_action.return_value = task
+        vm.api.services.get = MagicMock(side_effect=lambda template_uid, name: vdisks[name])
+
+        vm._update_vdisk_url()
+        assert [disk['url'] for disk in vm.data['disks']] == ['zdb://vdisk1', 'zdb://vdisk2']
+        for vdisk in vdisks.values():
+            vdisk.schedule_action.assert_called_once_with('private_url')
+            vdisk.schedule_action.return_value.wait.assert_called_once()
+
+        vm._update_vdisk_url()
+        vdisks['vdisk1'].schedule_action.assert_called_once_with('private_url')
+
+        vdisks['vdisk2'].data['nsName'] = 'other'
+        vm._update_vdisk_url()
+        vdisks['vdisk1'].schedule_action.assert_called_once_with('private_url')
+        assert vdisks['vdisk2'].schedule_action.call_count == 2
+
+        vm._update_vdisk_url(refresh=True)
+        assert vdisks['vdisk1'].schedule_action.call_count == 2
+
     def test_uninstall_vm(self):
         """
         Test successfully destroying the vm
@@ -185,9 +249,12 @@ class TestVmTemplate(ZrobotBaseTest):
         """
         vm = Vm('vm', data=self.valid_data)
         vm.state.set('actions', 'install', 'ok')
+        vm._update_vdisk_url = MagicMock()
         vm.reboot()
         vm._vm_sal.reboot.assert_called_with()
         vm.state.check('status', 'rebooting', 'ok')
+        # the zerodb of a vdisk might have been redeployed on another address
+        vm._update_vdisk_url.assert_called_once_with(refresh=True)
 
     def test_reset_vm_not_installed(self):
         """
@@ -290,6 +357,106 @@ class TestVmTemplate(ZrobotBaseTest):
         with pytest.raises(StateCheckError):
             vm.state.check('status', 'rebooting', 'ok')
 
+    def test_monitor_vm_running_listing(self):
+        """
+        Test monitor reuses the node vms listing and doesn't query the vm when it is running
+        """
+        vm = Vm('vm', data=self.valid_data)
+        vm.state.set('actions', 'install', 'ok')
+        vm.state.set('actions', 'start', 'ok')
+        vm._node_sal.client.kvm.list.return_value = [{'name': 'vm', 'state': 'running'}]
+
+        vm._monitor()
+        vm._monitor()
+
+        vm.state.check('status', 'running', 'ok')
+        vm._node_sal.client.kvm.list.assert_called_once_with()
+        assert not vm._vm_sal.is_running.called
+
+    def test_monitor_updates_info_status(self):
+        """
+        Test monitor keeps the status of the info snapshot up to date without querying the vm
+        """
+        vm = Vm('vm', data=self.valid_data)
+        vm_info = PropertyMock(return_value={'vnc': 5900, 'state': 'paused'})
+        type(vm._vm_sal).info = vm_info
+        assert vm.info()['status'] == 'paused'
+
+        vm.state.set('actions', 'install', 'ok')
+        vm.state.set('actions', 'start', 'ok')
+        vm._node_sal.client.kvm.list.return_value = [{'name': 'vm', 'state': 'running'}]
+        vm._monitor()
+
+        assert vm.info()['status'] == 'running'
+        assert vm_info.call_count == 1
+
+        # the rest of the snapshot expires
+        vm._info_refreshed -= VM_INFO_TTL + 1
+        assert vm.info()['status'] == 'paused'
+        assert vm_info.call_count == 2
+
+    def test_info_read_only(self):
+        """
+        Test info doesn't resolve the vdisk urls nor change the service data
+        """
+        vm = Vm('vm', data=self.valid_data)
+        vm._vm_sal.info = {'vnc': 5900, 'state': 'running'}
+        vm._update_vdisk_url = MagicMock()
+        vm.api.services.get = MagicMock()
+        vm._data_changed = MagicMock()
+
+        info = vm.info(refresh=True)
+        assert info['disks'] == vm.data['disks']
+        assert not vm._update_vdisk_url.called
+        assert not vm.api.services.get.called
+        assert not vm._data_changed.called
+
+    def test_info_zerotier(self):
+        """
+        Test info gets the zerotier members from the cache of the zerotier_client service
+        """
+        data = self.valid_data.copy()
+        data['ztIdentity'] = 'address:identity'
+        data['nics'] = [
+            {'type': 'zerotier', 'ztClient': 'zt', 'id': 'network'},
+            {'type': 'zerotier', 'ztClient': 'zt', 'id': 'network'},
+        ]
+        vm = Vm('vm', data=data)
+        vm._vm_sal.info = {'vnc': 5900, 'state': 'running'}
+        zt_service = MagicMock()
+        zt_service.network_member.return_value.get_private_ip.return_value = '10.0.0.1'
+        vm.api.services.get = MagicMock(return_value=zt_service)
+
+        info = vm.info()
+        assert [nic['ip'] for nic in info['nics']] == ['10.0.0.1', '10.0.0.1']
+        vm.api.services.get.assert_called_with(template_uid=ZT_TEMPLATE_UID, name='zt')
+        zt_service.network_member.assert_called_with('network', 'address', refresh=False)
+
+        zt_service.network_member.reset_mock()
+        vm.info(refresh=True)
+        # the network is only listed again for the first nic
+        assert zt_service.network_member.call_args_list == [
+            call('network', 'address', refresh=True), call('network', 'address', refresh=False)]
+
+    def test_info_zerotier_no_client_service(self):
+        """
+        Test info asks zerotier for the member when there is no zerotier_client service for the client
+        """
+        data = self.valid_data.copy()
+        data['ztIdentity'] = 'address:identity'
+        data['nics'] = [{'type': 'zerotier', 'ztClient': 'zt', 'id': 'network'}]
+        vm = Vm('vm', data=data)
+        vm._vm_sal.info = {'vnc': 5900, 'state': 'running'}
+        vm.api.services.get = MagicMock(side_effect=ServiceNotFoundError)
+        zerotier = patch('js9.j.clients.zerotier.get', MagicMock()).start()
+        network = zerotier.return_value.network_get.return_value
+        network.member_get.return_value.get_private_ip.return_value = '10.0.0.1'
+
+        info = vm.info()
+        assert info['nics'][0]['ip'] == '10.0.0.1'
+        zerotier.assert_called_once_with('zt')
+        network.member_get.assert_called_once_with(address='address')
+
     def test_monitor_before_install(self):
         """
         Test monitor before install
@@ -1,3 +1,5 @@
+import json
+
 from js9 import j
 from zerorobot.template.base import TemplateBase
 from zerorobot.template.state import StateCheckError
@@ -6,6 +8,31 @@ from zerorobot.template.state import StateCheckError
 NODE_TEMPLATE_UID = 'github.com/zero-os/0-templates/node/0.0.1'
 NODE_CLIENT = 'local'
 
+def _namespaces_diff(old, new):
+    """
+    Compute the 0-db commands needed to go from the old namespaces to the new ones
+    :param old: list of namespaces currently deployed
+    :param new: list of namespaces to deploy
+    :return: list of commands, each a tuple of the command arguments ex: ('NSSET', 'namespace', 'maxsize', 1024)
+    """
+    old_by_name = {namespace['name']: namespace for namespace in old}
+    new_by_name = {namespace['name']: namespace for namespace in new}
+    commands = [('NSDEL', name) for name in old_by_name if name not in new_by_name]
+
+    for namespace in new:
+        name = namespace['name']
+        existing = old_by_name.get(name)
+        if existing is None:
+            commands.append(('NSNEW', name))
+            existing = {}
+        if namespace.get('size') != existing.get('size'):
+            commands.append(('NSSET', name, 'maxsize', (namespace.get('size') or 0) * 1024 ** 3))
+        if namespace.get('password') != existing.get('password'):
+            commands.append(('NSSET', name, 'password', namespace.get('password') or '*'))
+        if namespace.get('public', True) != existing.get('public', True):
+            commands.append(('NSSET', name, 'public', 1 if namespace.get('public', True) else 0))
+    return commands
+
 
 class Zerodb(TemplateBase):
 
@@ -15,6 +42,10 @@ class Zerodb(TemplateBase):
     def __init__(self, name=None, guid=None, data=None):
         super().__init__(name=name, guid=guid, data=data)
         self.recurring_action('_monitor', 10)  # every 10 seconds
+        self._zerodb_sal_cache = (None, None)  # (node client, zerodb sal), reset by _data_changed
+        self._indexed_namespaces = None
+        self._deployed_config = None
+        self._namespace_positions = {}
 
     def validate(self):
         self.state.delete('status', 'running')
@@ -26,15 +57,42 @@ class Zerodb(TemplateBase):
 
     @property
     def _zerodb_sal(self):
-        data = self.data.copy()
-        data['name'] = self.name
-        return self._node_sal.primitives.from_dict('zerodb', data)
+        """
+        zerodb sal, only rebuilt when js9 gives another client for the node or the service data was changed
+        """
+        node_sal = self._node_sal
+        cached_client, zerodb_sal = self._zerodb_sal_cache
+        if cached_client is not node_sal.client:
+            data = self.data.copy()
+            data['name'] = self.name
+            zerodb_sal = node_sal.primitives.from_dict('zerodb', data)
+            self._zerodb_sal_cache = (node_sal.client, zerodb_sal)
+        return zerodb_sal
+
+    def _data_changed(self):
+        """
+        Must be called after changing the service data, so the zerodb sal is rebuilt from it
+        """
+        self._zerodb_sal_cache = (None, None)
+
+    def update_data(self, data):
+        super().update_data(data)
+        self._data_changed()
 
     def _deploy(self):
         zerodb_sal = self._zerodb_sal
         zerodb_sal.deploy()
         self.data['nodePort'] = zerodb_sal.node_port
         self.data['ztIdentity'] = zerodb_sal.zt_identity
+        self._data_changed()
+        self._deployed_config = self._container_config()
+
+    def _container_config(self):
+        """
+        Fingerprint of the service data that requires a full deploy of the 0-db when it changes
+        """
+        config = {key: self.data[key] for key in ('mode', 'sync', 'path', 'nics', 'admin', 'nodePort')}
+        return json.dumps(config, sort_keys=True, default=str)
 
     def _monitor(self):
         self.logger.info('Monitor zerodb %s' % self.name)
@@ -58,6 +116,7 @@ class Zerodb(TemplateBase):
         # generate admin password
         if not self.data['admin']:
             self.data['admin'] = j.data.idgenerator.generateXCharID(25)
+            self._data_changed()
 
         self._deploy()
         self.state.set('actions', 'install', 'ok')
@@ -81,6 +140,7 @@ class Zerodb(TemplateBase):
         self.logger.info('Stopping zerodb %s' % self.name)
 
         self._zerodb_sal.stop()
+        self._deployed_config = None
         self.state.delete('actions', 'start')
         self.state.delete('status', 'running')
 
@@ -149,8 +209,9 @@ class Zerodb(TemplateBase):
         self.state.check('status', 'running', 'ok')
         if self._namespace_exists_update_delete(name):
             raise ValueError('Namespace {} already exists'.format(name))
-        self.data['namespaces'].append({'name': name, 'size': size, 'password': password, 'public': public})
-        self._zerodb_sal.deploy()
+        changes = []
+        self._namespace_add({'name': name, 'size': size, 'password': password, 'public': public}, changes)
+        self._deploy_namespaces(changes)
 
     def namespace_set(self, name, prop, value):
         """
@@ -161,19 +222,129 @@ class Zerodb(TemplateBase):
         """
         self.state.check('status', 'running', 'ok')
 
-        if not self._namespace_exists_update_delete(name, prop, value):
+        changes = []
+        if not self._namespace_exists_update_delete(name, prop, value, changes=changes):
             raise LookupError('Namespace {} doesn\'t exist'.format(name))
-        self._zerodb_sal.deploy()
+        self._deploy_namespaces(changes)
 
     def namespace_delete(self, name):
         """
         Delete a namespace
         """
         self.state.check('status', 'running', 'ok')
-        if not self._namespace_exists_update_delete(name, delete=True):
+        changes = []
+        if not self._namespace_exists_update_delete(name, delete=True, changes=changes):
             return
 
-        self._zerodb_sal.deploy()
+        self._deploy_namespaces(changes)
+
+    def namespace_create_many(self, namespaces):
+        """
+        Create multiple namespaces and deploy the zerodb once
+        :param namespaces: list of namespaces, each a dict with the keys name, size, password and public
+        :return: list of {'name': name, 'error': error} in the same order as namespaces,
+                 error is None if the namespace was created
+        """
+        self.state.check('status', 'running', 'ok')
+        changes = []
+        results = []
+        for namespace in namespaces:
+            name = namespace.get('name')
+            try:
+                if not name:
+                    raise ValueError('Namespace name is required')
+                if self._namespace_exists_update_delete(name):
+                    raise ValueError('Namespace {} already exists'.format(name))
+                self._namespace_add({
+                    'name': name,
+                    'size': namespace.get('size'),
+                    'password': namespace.get('password'),
+                    'public': namespace.get('public', True),
+                }, changes)
+                results.append({'name': name, 'error': None})
+            except ValueError as err:
+                results.append({'name': name, 'error': str(err)})
+
+        if changes:
+            self._deploy_namespaces(changes)
+        return results
+
+    def namespace_set_many(self, properties):
+        """
+        Set properties of multiple namespaces and deploy the zerodb once
+        :param properties: list of dicts with the keys name, prop and value
+        :return: list of {'name': name, 'error': error} in the same order as properties,
+                 error is None if the property was set
+        """
+        self.state.check('status', 'running', 'ok')
+        changes = []
+        results = []
+        for item in properties:
+            name = item.get('name')
+            try:
+                if item.get('prop') not in ['size', 'password', 'public']:
+                    raise ValueError('Property must be size, password, or public')
+                if not self._namespace_exists_update_delete(name, item['prop'], item.get('value'), changes=changes):
+                    raise LookupError('Namespace {} doesn\'t exist'.format(name))
+                results.append({'name': name, 'error': None})
+            except (ValueError, LookupError) as err:
+                results.append({'name': name, 'error': str(err)})
+
+        if changes:
+            self._deploy_namespaces(changes)
+        return results
+
+    def namespace_delete_many(self, names):
+        """
+        Delete multiple namespaces and deploy the zerodb once
+        Deleting a namespace that doesn't exist is a no op, like namespace_delete
+        :param names: list of namespace names
+        :return: list of {'name': name, 'error': error} in the same order as names
+        """
+        self.state.check('status', 'running', 'ok')
+        changes = []
+        results = []
+        for name in names:
+            self._namespace_exists_update_delete(name, delete=True, changes=changes)
+            results.append({'name': name, 'error': None})
+
+        if changes:
+            self._deploy_namespaces(changes)
+        return results
+
+    def _deploy_namespaces(self, changes):
+        """
+        Deploy the namespaces of the service data, undo the changes if the deploy fails.
+        If the 0-db was deployed by this service and only namespaces changed since, only the namespace
+        changes are sent to the running 0-db. Otherwise the whole 0-db is deployed.
+        :param changes: namespace changes recorded by _namespace_add and _namespace_exists_update_delete
+        """
+        if self._deployed_config is not None and self._deployed_config == self._container_config():
+            try:
+                self._apply_namespace_commands(_namespaces_diff(*self._changed_namespaces(changes)))
+                return
+            except Exception as err:
+                self.logger.warning('Failed to apply namespace changes to zerodb %s, deploying it: %s', self.name, str(err))
+
+        try:
+            self._zerodb_sal.deploy()
+            self._deployed_config = self._container_config()
+        except:
+            self.logger.error('Failed to deploy namespaces, restoring zerodb to previous state')
+            self._undo_namespace_changes(changes)
+            self._zerodb_sal.deploy()
+            raise
+
+    def _apply_namespace_commands(self, commands):
+        """
+        Send namespace commands to the running 0-db using the admin password
+        :param commands: list of commands as returned by _namespaces_diff
+        """
+        if not commands:
+            return
+        client = j.clients.redis.get(self._node_sal.public_addr, self.data['nodePort'], password=self.data['admin'])
+        for command in commands:
+            client.execute_command(*command)
 
     def connection_info(self):
         return {
@@ -181,19 +352,97 @@ class Zerodb(TemplateBase):
             'port': self.data['nodePort']
         }
 
-    def _namespace_exists_update_delete(self, name, prop=None, value=None, delete=False):
+    def _namespace_exists_update_delete(self, name, prop=None, value=None, delete=False, changes=None):
+        """
+        Check if a namespace exists, and set one of its properties or delete it
+        :param changes: list the change is recorded in, see _undo_namespace_changes
+        :return: True if the namespace exists
+        """
         if prop and delete:
             raise ValueError('Can\'t set property and delete at the same time')
         if prop and prop not in ['size', 'password', 'public']:
             raise ValueError('Property must be size, password, or public')
 
-        for namespace in self.data['namespaces']:
-            if namespace['name'] == name:
-                if prop:
-                    if prop not in ['size', 'password', 'public']:
-                        raise ValueError('Property must be size, password, or public')
-                    namespace[prop] = value
-                if delete:
-                    self.data['namespaces'].remove(namespace)
-                return True
-        return False
+        positions = self._namespaces_index()
+        position = positions.get(name)
+        if position is None:
+            return False
+        namespaces = self.data['namespaces']
+        namespace = namespaces[position]
+        if prop and namespace.get(prop) != value:
+            if changes is not None:
+                changes.append(('set', name, position, dict(namespace)))
+            namespace[prop] = value
+            self._data_changed()
+        if delete:
+            del namespaces[position]
+            del positions[name]
+            self._reindex_namespaces(position)
+            if changes is not None:
+                changes.append(('delete', name, position, namespace))
+            self._data_changed()
+        return True
+
+    def _namespace_add(self, namespace, changes=None):
+        """
+        Add a namespace to the service data and to the namespaces index
+        :param changes: list the change is recorded in, see _undo_namespace_changes
+        """
+        positions = self._namespaces_index()
+        positions[namespace['name']] = len(self.data['namespaces'])
+        self.data['namespaces'].append(namespace)
+        if changes is not None:
+            changes.append(('add', namespace['name'], positions[namespace['name']], None))
+        self._data_changed()
+
+    def _undo_namespace_changes(self, changes):
+        """
+        Undo namespace changes, most recent first
+        :param changes: list of (action, namespace name, position, namespace before the change or None if added)
+        """
+        namespaces = self.data['namespaces']
+        positions = self._namespaces_index()
+        for action, name, position, previous in reversed(changes):
+            if action == 'add':
+                namespaces.pop()
+                del positions[name]
+            elif action == 'set':
+                namespaces[position] = previous
+            else:
+                namespaces.insert(position, previous)
+                self._reindex_namespaces(position)
+        self._data_changed()
+
+    def _changed_namespaces(self, changes):
+        """
+        :param changes: namespace changes, see _undo_namespace_changes
+        :return: the changed namespaces before and after the changes
+        """
+        before = {}
+        for _, name, _, previous in changes:
+            before.setdefault(name, previous)
+        positions = self._namespaces_index()
+        namespaces = self.data['namespaces']
+        after = [namespaces[positions[name]] for name in before if name in positions]
+        return [namespace for namespace in before.values() if namespace is not None], after
+
+    def _namespaces_index(self):
+        """
+        Index of the namespaces of the service data by name.
+        It is rebuilt when the namespaces list was replaced or changed size without going through
+        _namespace_add or _namespace_exists_update_delete, e.g. when the service data is loaded or updated
+        :return: dict mapping the namespace name to its position in the namespaces of the service data
+        """
+        namespaces = self.data['namespaces']
+        if self._indexed_namespaces is not namespaces or len(self._namespace_positions) != len(namespaces):
+            self._namespace_positions = {namespace['name']: position for position, namespace in enumerate(namespaces)}
+            self._indexed_namespaces = namespaces
+        return self._namespace_positions
+
+    def _reindex_namespaces(self, start):
+        """
+        Update the positions of the namespaces from start on, after one was deleted or inserted before them
+        """
+        namespaces = self.data['namespaces']
+        for position in range(start, len(namespaces)):
+            self._namespace_positions[namespaces[position]['name']] = position
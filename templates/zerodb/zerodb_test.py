@@ -3,7 +3,7 @@ import copy
 import os
 import pytest
 
-from zerodb import Zerodb, NODE_CLIENT
+from zerodb import Zerodb, NODE_CLIENT, _namespaces_diff
 from zerorobot.template.state import StateCheckError
 from zerorobot.service_collection import ServiceNotFoundError
 
@@ -59,6 +59,19 @@ class TestZerodbTemplate(ZrobotBaseTest):
         assert zdb._zerodb_sal == zdb_sal
         zdb._node_sal.primitives.from_dict.assert_called_once_with('zerodb', self.valid_data)
 
+    def test_zerodb_sal_cached(self):
+        """
+        Test _zerodb_sal property is only rebuilt when the data changes
+        """
+        zdb = Zerodb('zdb', data=self.valid_data)
+        zdb._zerodb_sal
+        zdb._zerodb_sal
+        assert zdb._node_sal.primitives.from_dict.call_count == 1
+
+        zdb._namespace_add({'name': 'namespace', 'size': 20, 'public': True, 'password': ''})
+        zdb._zerodb_sal
+        assert zdb._node_sal.primitives.from_dict.call_count == 2
+
     def test_install_empty_password(self):
         """
         Test install action sets admin password if empty
@@ -265,6 +278,170 @@ class TestZerodbTemplate(ZrobotBaseTest):
         zdb.namespace_delete('namespace')
         zdb._zerodb_sal.deploy.assert_called_once_with()
 
+    def test_namespace_create_many(self):
+        """
+        Test namespace_create_many action deploys once and reports the namespaces that failed
+        """
+        self.valid_data['namespaces'].append({'name': 'existing', 'size': 20, 'public': True, 'password': ''})
+        zdb = Zerodb('zdb', data=self.valid_data)
+        zdb.state.set('status', 'running', 'ok')
+        results = zdb.namespace_create_many([
+            {'name': 'ns1', 'size': 10, 'password': 'secret'},
+            {'name': 'existing'},
+            {'name': 'ns2', 'size': 20, 'public': False},
+            {'name': 'ns1'},
+        ])
+
+        zdb._zerodb_sal.deploy.assert_called_once_with()
+        assert [result['name'] for result in results] == ['ns1', 'existing', 'ns2', 'ns1']
+        assert results[0]['error'] is None
+        assert results[1]['error'] == 'Namespace existing already exists'
+        assert results[2]['error'] is None
+        assert results[3]['error'] == 'Namespace ns1 already exists'
+        assert [ns['name'] for ns in zdb.data['namespaces']] == ['existing', 'ns1', 'ns2']
+
+    def test_namespace_create_many_deploy_fails(self):
+        """
+        Test namespace_create_many action restores the namespaces if the deploy fails
+        """
+        zdb = Zerodb('zdb', data=self.valid_data)
+        zdb.state.set('status', 'running', 'ok')
+        zdb._zerodb_sal.deploy.side_effect = [RuntimeError, None]
+        with pytest.raises(RuntimeError):
+            zdb.namespace_create_many([{'name': 'ns1'}, {'name': 'ns2'}])
+        assert zdb.data['namespaces'] == []
+
+    def test_undo_namespace_changes(self):
+        """
+        Test the namespace changes are undone in place when the deploy fails
+        """
+        for name in ('ns1', 'ns2', 'ns3'):
+            self.valid_data['namespaces'].append({'name': name, 'size': 20, 'public': True, 'password': ''})
+        zdb = Zerodb('zdb', data=self.valid_data)
+        zdb.state.set('status', 'running', 'ok')
+        namespaces = zdb.data['namespaces']
+        expected = [dict(namespace) for namespace in namespaces]
+        zdb._zerodb_sal.deploy.side_effect = [RuntimeError, None, RuntimeError, None]
+
+        with pytest.raises(RuntimeError):
+            zdb.namespace_delete_many(['ns1', 'ns3'])
+        with pytest.raises(RuntimeError):
+            zdb.namespace_set_many([{'name': 'ns2', 'prop': 'size', 'value': 30}])
+
+        assert zdb.data['namespaces'] is namespaces
+        assert namespaces == expected
+        assert zdb._namespaces_index() == {'ns1': 0, 'ns2': 1, 'ns3': 2}
+
+    def test_namespace_set_many(self):
+        """
+        Test namespace_set_many action
+        """
+        self.valid_data['namespaces'].append({'name': 'ns1', 'size': 20, 'public': True, 'password': ''})
+        zdb = Zerodb('zdb', data=self.valid_data)
+        zdb.state.set('status', 'running', 'ok')
+        results = zdb.namespace_set_many([
+            {'name': 'ns1', 'prop': 'size', 'value': 30},
+            {'name': 'ns2', 'prop': 'size', 'value': 30},
+            {'name': 'ns1', 'prop': 'name', 'value': 'ns3'},
+        ])
+
+        zdb._zerodb_sal.deploy.assert_called_once_with()
+        assert results[0]['error'] is None
+        assert results[1]['error'] is not None
+        assert results[2]['error'] is not None
+        assert zdb.data['namespaces'] == [{'name': 'ns1', 'size': 30, 'public': True, 'password': ''}]
+
+    def test_namespace_delete_many(self):
+        """
+        Test namespace_delete_many action
+        """
+        self.valid_data['namespaces'].append({'name': 'ns1', 'size': 20, 'public': True, 'password': ''})
+        self.valid_data['namespaces'].append({'name': 'ns2', 'size': 20, 'public': True, 'password': ''})
+        zdb = Zerodb('zdb', data=self.valid_data)
+        zdb.state.set('status', 'running', 'ok')
+        zdb.namespace_delete_many(['ns1', 'ns2', 'ns3'])
+
+        zdb._zerodb_sal.deploy.assert_called_once_with()
+        assert zdb.data['namespaces'] == []
+
+    def test_namespace_delete_many_keeps_order(self):
+        """
+        Test namespace_delete_many doesn't reorder the remaining namespaces
+        """
+        for name in ('ns1', 'ns2', 'ns3', 'ns4'):
+            self.valid_data['namespaces'].append({'name': name, 'size': 20, 'public': True, 'password': ''})
+        zdb = Zerodb('zdb', data=self.valid_data)
+        zdb.state.set('status', 'running', 'ok')
+        zdb.namespace_delete_many(['ns1', 'ns3'])
+
+        assert [namespace['name'] for namespace in zdb.data['namespaces']] == ['ns2', 'ns4']
+        assert zdb._namespaces_index() == {'ns2': 0, 'ns4': 1}
+
+    def test_namespace_delete_many_nothing_deleted(self):
+        """
+        Test namespace_delete_many action doesn't deploy if no namespace was deleted
+        """
+        zdb = Zerodb('zdb', data=self.valid_data)
+        zdb.state.set('status', 'running', 'ok')
+        zdb.namespace_delete_many(['ns1'])
+
+        assert not zdb._zerodb_sal.deploy.called
+
+    def test_namespaces_diff(self):
+        """
+        Test _namespaces_diff only emits the commands for the namespaces that changed
+        """
+        old = [
+            {'name': 'deleted', 'size': 10, 'password': '', 'public': True},
+            {'name': 'unchanged', 'size': 10, 'password': 'secret', 'public': True},
+            {'name': 'changed', 'size': 10, 'password': 'secret', 'public': True},
+        ]
+        new = [
+            {'name': 'unchanged', 'size': 10, 'password': 'secret', 'public': True},
+            {'name': 'changed', 'size': 20, 'password': None, 'public': False},
+            {'name': 'created', 'size': 1, 'password': 'secret', 'public': True},
+        ]
+        assert _namespaces_diff(old, new) == [
+            ('NSDEL', 'deleted'),
+            ('NSSET', 'changed', 'maxsize', 20 * 1024 ** 3),
+            ('NSSET', 'changed', 'password', '*'),
+            ('NSSET', 'changed', 'public', 0),
+            ('NSNEW', 'created'),
+            ('NSSET', 'created', 'maxsize', 1024 ** 3),
+            ('NSSET', 'created', 'password', 'secret'),
+        ]
+
+    def test_namespace_create_incremental(self):
+        """
+        Test namespace_create only sends the namespace commands when the zerodb was deployed by the service
+        """
+        redis_get = patch('js9.j.clients.redis.get', MagicMock()).start()
+        zdb = Zerodb('zdb', data=self.valid_data)
+        zdb._node_sal.primitives.from_dict.return_value = MagicMock(node_port=9900, zt_identity='')
+        zdb.state.set('status', 'running', 'ok')
+        zdb._deploy()
+        zdb.namespace_create('namespace', 1)
+
+        zdb._zerodb_sal.deploy.assert_called_once_with()
+        redis_get.return_value.execute_command.assert_has_calls([
+            call('NSNEW', 'namespace'),
+            call('NSSET', 'namespace', 'maxsize', 1024 ** 3),
+        ])
+
+    def test_namespace_create_incremental_fails(self):
+        """
+        Test namespace_create deploys the whole zerodb if sending the namespace commands fails
+        """
+        redis_get = patch('js9.j.clients.redis.get', MagicMock()).start()
+        redis_get.return_value.execute_command.side_effect = ConnectionError()
+        zdb = Zerodb('zdb', data=self.valid_data)
+        zdb._node_sal.primitives.from_dict.return_value = MagicMock(node_port=9900, zt_identity='')
+        zdb.state.set('status', 'running', 'ok')
+        zdb._deploy()
+        zdb.namespace_create('namespace', 1)
+
+        assert zdb._zerodb_sal.deploy.call_count == 2
+
     def test_deploy(self):
         """
         Test _deploy helper function
@@ -340,6 +517,23 @@ class TestZerodbTemplate(ZrobotBaseTest):
         assert zdb._namespace_exists_update_delete('namespace', delete=True) is True
         assert zdb.data['namespaces'] == []
 
+    def test_namespaces_index(self):
+        """
+        Test the namespaces index follows the changes of the service data
+        """
+        self.valid_data['namespaces'].append({'name': 'ns1', 'size': 20, 'public': True, 'password': ''})
+        zdb = Zerodb('zdb', data=self.valid_data)
+        assert list(zdb._namespaces_index().keys()) == ['ns1']
+
+        zdb._namespace_add({'name': 'ns2', 'size': 20, 'public': True, 'password': ''})
+        zdb._namespace_exists_update_delete('ns1', delete=True)
+        assert list(zdb._namespaces_index().keys()) == ['ns2']
+
+        zdb.data['namespaces'] = [{'name': 'ns3', 'size': 20, 'public': True, 'password': ''}]
+        assert list(zdb._namespaces_index().keys()) == ['ns3']
+        assert zdb._namespace_exists_update_delete('ns2') is False
+        assert zdb._namespace_exists_update_delete('ns3') is True
+
     def test_namespace_url_before_start(self):
         """
         Test namespace_url action without start
@@ -1,13 +1,59 @@
+import random
+import time
+from contextlib import contextmanager
+
+import gevent
 from gevent import sleep
+from gevent.pool import Pool
 
 from js9 import j
 from zerorobot.template.base import TemplateBase
-from zerorobot.template.decorator import timeout
 from zerorobot.template.state import StateCheckError
 
 NODE_TEMPLATE_UID = 'github.com/zero-os/0-templates/node/0.0.1'
 ERP_TEMPLATE_UID = 'github.com/zero-os/0-templates/erp_registeration/0.0.1'
 HARDWARE_CHECK_TEMPLATE_UID = 'github.com/zero-os/0-templates/hardware_check/0.0.1'
+ONBOARDING_WORKERS = 10
+ONBOARDING_TIMEOUT = 10 * 60
+NODE_CLIENT_TIMEOUT = 120
+REGISTER_TIMEOUT = 120  # seconds to wait for the hardware check and erp registration of a node
+PING_TIMEOUT = 10
+WAIT_INTERVAL = 0.5
+WAIT_MAX_INTERVAL = 5
+
+
+def _node_client_instance(node_id):
+    return 'bootstrap_%s' % node_id
+
+
+def _wait_for(condition, timeout, error_message, interval=WAIT_INTERVAL, max_interval=WAIT_MAX_INTERVAL):
+    """
+    Call condition until it returns a truthy value and return that value
+
+    Attempts are spaced by an exponential backoff with jitter, an exception raised by
+    condition counts as a failed attempt, except the timeouts of the caller which are raised.
+    Only the calling greenlet sleeps between attempts so any number of waiters can run concurrently.
+    :raises TimeoutError: if condition didn't succeed within timeout seconds
+    """
+    deadline = time.monotonic() + timeout
+    last_error = None
+    while True:
+        try:
+            result = condition()
+            if result:
+                return result
+        except (gevent.Timeout, OnboardingTimeoutError):
+            raise
+        except Exception as err:
+            last_error = err
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            if last_error is not None:
+                error_message = '%s: %s' % (error_message, last_error)
+            raise TimeoutError(error_message)
+        sleep(min(random.uniform(interval / 2, interval), remaining))
+        interval = min(interval * 2, max_interval)
 
 
 class ZeroosBootstrap(TemplateBase):
@@ -17,6 +63,16 @@ class ZeroosBootstrap(TemplateBase):
 
     def __init__(self, name=None, guid=None, data=None):
         super().__init__(name=name, guid=guid, data=data)
+        self._onboarding_pool = Pool(ONBOARDING_WORKERS)
+        # nodeId -> greenlet of the members being onboarded
+        self._onboarding = {}
+        # zerotier members cache, indexed by nodeId and by assigned ip
+        self._members = {}
+        self._members_by_ip = {}
+        # nodeId -> state of the member last seen by bootstrap
+        self._member_states = {}
+        # phase -> timing metrics of the onboarding phases
+        self._phase_timings = {}
 
         # start recurring action
         self.recurring_action('bootstrap', 10)
@@ -37,17 +93,85 @@ class ZeroosBootstrap(TemplateBase):
     def bootstrap(self):
         self.logger.info("start discovering new members")
 
-        netid = self.data['zerotierNetID']
+        members = self._changed_members(self._refresh_members())
+        for i, member in enumerate(members):
+            if member['nodeId'] in self._onboarding:
+                # still being onboarded by a previous run
+                continue
+            if not member['online'] or member['config']['authorized']:
+                continue
+            if not self._onboarding_pool.free_count():
+                # the remaining members are picked up by the next run
+                self.logger.info("all onboarding workers are busy")
+                for pending in members[i:]:
+                    self._member_states.pop(pending['nodeId'], None)
+                break
+            self._onboarding[member['nodeId']] = self._onboarding_pool.spawn(self._onboard_member, member)
 
+    def _refresh_members(self):
+        """
+        update the members cache from the zerotier network
+        """
+        netid = self.data['zerotierNetID']
         resp = self._zt.client.network.listMembers(netid)
         members = resp.json()
 
+        node_ids = set()
         for member in members:
-            try:
+            node_ids.add(member['nodeId'])
+            self._cache_member(member)
+        for node_id in set(self._members) - node_ids:
+            self._uncache_member(node_id)
+        return members
+
+    def _cache_member(self, member):
+        node_id = member['nodeId']
+        self._uncache_member(node_id)
+        self._members[node_id] = member
+        for ip in member['config']['ipAssignments']:
+            self._members_by_ip[ip] = node_id
+
+    def _uncache_member(self, node_id):
+        member = self._members.pop(node_id, None)
+        if member is None:
+            return
+        for ip in member['config']['ipAssignments']:
+            if self._members_by_ip.get(ip) == node_id:
+                del self._members_by_ip[ip]
+
+    def _changed_members(self, members):
+        """
+        return the members that are new or whose state changed since the previous call
+        """
+        changed = []
+        node_ids = set()
+        for member in members:
+            node_ids.add(member['nodeId'])
+            state = (member['online'], member['config']['authorized'], tuple(member['config']['ipAssignments']))
+            if self._member_states.get(member['nodeId']) != state:
+                self._member_states[member['nodeId']] = state
+                changed.append(member)
+        for node_id in set(self._member_states) - node_ids:
+            del self._member_states[node_id]
+        return changed
+
+    def _onboard_member(self, member):
+        try:
+            error = OnboardingTimeoutError("onboarding of member %s took too long" % member['nodeId'])
+            with gevent.Timeout(ONBOARDING_TIMEOUT, error), self._phase('onboarding'):
                 self._add_node(member)
-            except Exception as err:
-                self.logger.error(str(err))
+        except Exception as err:
+            self.logger.error("failed to onboard member %s: %s", member['nodeId'], str(err))
+            try:
                 self._unauthorize_member(member)
+            except Exception as err:
+                self.logger.error("failed to unauthorize member %s: %s", member['nodeId'], str(err))
+            # make sure the next run tries this member again
+            self._member_states.pop(member['nodeId'], None)
+        finally:
+            self._onboarding.pop(member['nodeId'], None)
+            # the node client is only needed during onboarding
+            j.clients.zos.delete(_node_client_instance(member['nodeId']))
 
     def _authorize_member(self, member):
         self.logger.info("authorize new member %s", member['nodeId'])
@@ -61,82 +185,95 @@ class ZeroosBootstrap(TemplateBase):
         member['config']['authorized'] = False
         self._zt.client.network.updateMember(member, member['nodeId'], netid)
 
-    @timeout(20, error_message='Node did not get an ip assigned')
     def _wait_member_ip(self, member):
         self.logger.info("wait ip for member %s", member['nodeId'])
         netid = self.data['zerotierNetID']
 
-        resp = self._zt.client.network.getMember(member['nodeId'], netid)
-        member = resp.json()
-
-        while True:
+        def member_ip():
             self.logger.info('Checking ip assignments for node with id %s' % member['nodeId'])
-            if len(member['config']['ipAssignments']):
-                break
-            sleep(1)
             resp = self._zt.client.network.getMember(member['nodeId'], netid)
-            member = resp.json()
+            ip_assignments = resp.json()['config']['ipAssignments']
+            if ip_assignments:
+                return ip_assignments[0]
 
-        zerotier_ip = member['config']['ipAssignments'][0]
-        return zerotier_ip
-
-    def _get_node_sal(self, ip, timeout=120):
-        instance = 'bootstrap'
-        j.clients.zos.delete(instance)
+        return _wait_for(member_ip, 20, 'Node did not get an ip assigned')
 
+    def _get_node_sal(self, instance, ip):
         data = {
             'host': ip,
             'port': 6379,
             'password_': self.data.get('redisPassword', ''),
             'db': 0,
             'ssl': True,
-            'timeout': timeout,
+            'timeout': NODE_CLIENT_TIMEOUT,
         }
 
-        # ensure client config
-        cl = j.clients.zos.get(
+        # the client is kept in memory only, its config is never saved
+        client = j.clients.zos.get(
             instance=instance,
             data=data,
             create=True,
             die=True,
             interactive=False)
 
-        cl.config.save()
-
-        # get a node object from the zero-os SAL
-        return j.clients.zos.sal.get_node(instance)
+        # get a node object from the zero-os SAL, built on that client: looking the instance up
+        # by name would load its saved config, which doesn't exist
+        return j.clients.zos.sal.get_node(instance, zos_client=client)
 
-    @timeout(60, error_message="can't connect, unauthorizing member")
     def _ping_node(self, node_sal, zerotier_ip):
         self.logger.info("connection to g8os with IP: %s", zerotier_ip)
-        while True:
-            try:
+
+        def ping():
+            # don't wait for the client timeout while the node is still booting
+            with gevent.Timeout(PING_TIMEOUT, TimeoutError('ping timeout')):
                 node_sal.client.ping()
-                break
-            except Exception as e:
-                continue
+            return True
+
+        _wait_for(ping, 60, "can't connect, unauthorizing member")
+
+    @contextmanager
+    def _phase(self, name):
+        """
+        record how long an onboarding phase takes
+        """
+        timings = self._phase_timings.setdefault(name, {'count': 0, 'failures': 0, 'total': 0, 'max': 0})
+        start = time.monotonic()
+        try:
+            yield
+        except BaseException:
+            timings['failures'] += 1
+            raise
+        finally:
+            duration = time.monotonic() - start
+            timings['count'] += 1
+            timings['total'] += duration
+            timings['max'] = max(timings['max'], duration)
+            self.logger.debug("onboarding phase %s took %.2fs", name, duration)
 
     def _add_node(self, member):
         if not member['online'] or member['config']['authorized']:
             return
 
         netid = self.data['zerotierNetID']
+        # members are onboarded concurrently, each needs its own client instance
+        instance = _node_client_instance(member['nodeId'])
 
         # authorized new member
         self._authorize_member(member)
 
         # get assigned ip of this member
-        zerotier_ip = self._wait_member_ip(member)
+        with self._phase('ip'):
+            zerotier_ip = self._wait_member_ip(member)
 
-        # create client configuration for that node, to test the connection
-        node_sal = self._get_node_sal(zerotier_ip, timeout=10)
-        self._ping_node(node_sal, zerotier_ip)
+        # create a client for that node, its connection is reused to install the node
+        with self._phase('ping'):
+            node_sal = self._get_node_sal(instance, zerotier_ip)
+            self._ping_node(node_sal, zerotier_ip)
 
-        # create client configuration for that node, to start installing it
-        node_sal = self._get_node_sal(zerotier_ip, timeout=120)
-
-        for hw_check in self.api.services.find(template_uid=HARDWARE_CHECK_TEMPLATE_UID):
-            hw_check.schedule_action('register', args={'node_name': node_sal.name}).wait(die=True)
+        with self._phase('hardware_check'):
+            for hw_check in self.api.services.find(template_uid=HARDWARE_CHECK_TEMPLATE_UID):
+                task = hw_check.schedule_action('register', args={'node_name': node_sal.name})
+                task.wait(timeout=REGISTER_TIMEOUT, die=True)
 
         # connection succeeded, set the hostname of the node to zerotier member
         name = node_sal.name
@@ -177,30 +314,47 @@ class ZeroosBootstrap(TemplateBase):
         }
         self.logger.info("create node.zero-os service {}".format(name))
         node = self.api.services.create(NODE_TEMPLATE_UID, name, data=data)
-        task_install = node.schedule_action('install')
+        with self._phase('install'):
+            task_install = node.schedule_action('install')
 
-        try:
-            task_install.wait(120)
-        except TimeoutError as err:
-            self.logger.error("node %s took too long to install", name)
-            node.delete()
-            raise err
-        if task_install.state == 'error':
-            node.delete()
-            raise RuntimeError(
-                "unexpected error during installation of node %s: %s" % (name, task_install.eco.errormessage))
-
-        for erp in self.api.services.find(template_uid=ERP_TEMPLATE_UID):
-            erp.schedule_action('register', args={'node_name': name}).wait(die=True)
+            try:
+                task_install.wait(120)
+            except TimeoutError as err:
+                self.logger.error("node %s took too long to install", name)
+                node.delete()
+                raise err
+            if task_install.state == 'error':
+                node.delete()
+                raise RuntimeError(
+                    "unexpected error during installation of node %s: %s" % (name, task_install.eco.errormessage))
+
+        with self._phase('register'):
+            for erp in self.api.services.find(template_uid=ERP_TEMPLATE_UID):
+                erp.schedule_action('register', args={'node_name': name}).wait(timeout=REGISTER_TIMEOUT, die=True)
 
     def delete_node(self, redis_addr):
         """
         this method will be called from the node.zero-os to remove the node from zerotier
         """
-        netid = self.data['zerotierNetID']
-        resp = self._zt.client.network.listMembers(netid)
-        members = resp.json()
+        node_id = self._members_by_ip.get(redis_addr)
+        if node_id is None:
+            # the member might have joined since the last bootstrap run
+            self._refresh_members()
+            node_id = self._members_by_ip.get(redis_addr)
+        if node_id is not None:
+            self._unauthorize_member(self._members[node_id])
+
+    def stats(self):
+        """
+        return the timing metrics of the onboarding phases, in seconds
+        """
+        stats = {}
+        for name, timings in self._phase_timings.items():
+            stats[name] = dict(timings, average=timings['total'] / timings['count'])
+        return stats
 
-        for member in members:
-            if redis_addr in member['config']['ipAssignments']:
-                self._unauthorize_member(member)
+
+class OnboardingTimeoutError(TimeoutError):
+    """
+    Raised in the greenlet onboarding a member once it took longer than ONBOARDING_TIMEOUT
+    """
@@ -2,7 +2,11 @@ from unittest.mock import MagicMock, patch
 import os
 import pytest
 
-from zeroos_bootstrap import ZeroosBootstrap
+import gevent
+from gevent.pool import Pool
+from js9 import j
+
+from zeroos_bootstrap import ZeroosBootstrap, OnboardingTimeoutError, REGISTER_TIMEOUT, _wait_for
 from zerorobot.template.state import StateCheckError
 from zerorobot.service_collection import ServiceNotFoundError
 
@@ -32,6 +36,7 @@ class TestBootstrapTemplate(ZrobotBaseTest):
 
     def setUp(self):
         patch('js9.j.clients.zerotier.get', MagicMock()).start()
+        patch('js9.j.clients.zos.delete', MagicMock()).start()
 
     def tearDown(self):
         patch.stopall()
@@ -61,18 +66,113 @@ class TestBootstrapTemplate(ZrobotBaseTest):
 
     def test_bootstrap(self):
         """
-        Test creating service with valid data
+        Test bootstrap onboards members and unauthorizes the ones that failed
         """
         bootstrap = ZeroosBootstrap('bootstrap', data=self.valid_data)
         bootstrap.api.get_robot = MagicMock()
         bootstrap._add_node = MagicMock(side_effect=[Exception, None])
         bootstrap._unauthorize_member = MagicMock()
+        member1 = {'nodeId': 'member1', 'online': True, 'config': {'authorized': False, 'ipAssignments': []}}
+        member2 = {'nodeId': 'member2', 'online': True, 'config': {'authorized': False, 'ipAssignments': []}}
+        resp = MagicMock()
+        resp.json = MagicMock(return_value=[member1, member2])
+        bootstrap._zt.client.network.listMembers = MagicMock(return_value=resp)
+        bootstrap.bootstrap()
+        bootstrap._onboarding_pool.join()
+
+        assert bootstrap._add_node.call_count == 2
+        bootstrap._unauthorize_member.assert_called_once_with(member1)
+        assert bootstrap._onboarding == {}
+
+    def test_bootstrap_node_client(self):
+        """
+        Test onboarding uses one node client for the whole onboarding and deletes it afterwards
+        """
+        delete = patch('js9.j.clients.zos.delete', MagicMock()).start()
+        bootstrap = ZeroosBootstrap('bootstrap', data=self.valid_data)
+        bootstrap._authorize_member = MagicMock()
+        bootstrap._wait_member_ip = MagicMock(return_value='127.0.0.1')
+        bootstrap._get_node_sal = MagicMock()
+        bootstrap._ping_node = MagicMock()
+        bootstrap.api.services.find = MagicMock(return_value=[])
+        member = {'nodeId': 'member', 'online': True, 'config': {'authorized': False, 'ipAssignments': []}}
+        resp = MagicMock()
+        resp.json = MagicMock(return_value=[member])
+        bootstrap._zt.client.network.listMembers = MagicMock(return_value=resp)
+        bootstrap.bootstrap()
+        bootstrap._onboarding_pool.join()
+
+        bootstrap._get_node_sal.assert_called_once_with('bootstrap_member', '127.0.0.1')
+        delete.assert_called_once_with('bootstrap_member')
+
+    def test_bootstrap_skip_members(self):
+        """
+        Test bootstrap doesn't onboard members that are offline, authorized or already being onboarded
+        """
+        bootstrap = ZeroosBootstrap('bootstrap', data=self.valid_data)
+        bootstrap._add_node = MagicMock()
+        members = [
+            {'nodeId': 'offline', 'online': False, 'config': {'authorized': False, 'ipAssignments': []}},
+            {'nodeId': 'authorized', 'online': True, 'config': {'authorized': True, 'ipAssignments': []}},
+            {'nodeId': 'onboarding', 'online': True, 'config': {'authorized': False, 'ipAssignments': []}},
+            {'nodeId': 'new', 'online': True, 'config': {'authorized': False, 'ipAssignments': []}},
+        ]
+        resp = MagicMock()
+        resp.json = MagicMock(return_value=members)
+        bootstrap._zt.client.network.listMembers = MagicMock(return_value=resp)
+        bootstrap._onboarding['onboarding'] = MagicMock()
+        bootstrap.bootstrap()
+        bootstrap._onboarding_pool.join()
+
+        bootstrap._add_node.assert_called_once_with(members[3])
+
+    def test_bootstrap_workers_busy(self):
+        """
+        Test bootstrap leaves members to the next run when all workers are busy
+        """
+        bootstrap = ZeroosBootstrap('bootstrap', data=self.valid_data)
+        bootstrap._onboarding_pool = Pool(1)
+        bootstrap._add_node = MagicMock()
+        member1 = {'nodeId': 'member1', 'online': True, 'config': {'authorized': False, 'ipAssignments': []}}
+        member2 = {'nodeId': 'member2', 'online': True, 'config': {'authorized': False, 'ipAssignments': []}}
+        resp = MagicMock()
+        resp.json = MagicMock(return_value=[member1, member2])
+        bootstrap._zt.client.network.listMembers = MagicMock(return_value=resp)
+        bootstrap.bootstrap()
+        bootstrap._onboarding_pool.join()
+
+        bootstrap._add_node.assert_called_once_with(member1)
+
+    def test_bootstrap_changed_members(self):
+        """
+        Test bootstrap only onboards members that are new or changed since the previous run
+        """
+        bootstrap = ZeroosBootstrap('bootstrap', data=self.valid_data)
+        bootstrap._add_node = MagicMock(side_effect=[Exception, None])
+        bootstrap._unauthorize_member = MagicMock()
+        member = {'nodeId': 'member', 'online': False, 'config': {'authorized': False, 'ipAssignments': []}}
         resp = MagicMock()
-        resp.json = MagicMock(return_value=['member1', 'member2'])
+        resp.json = MagicMock(side_effect=lambda: [dict(member)])
         bootstrap._zt.client.network.listMembers = MagicMock(return_value=resp)
+
+        # member is offline, then unchanged
+        bootstrap.bootstrap()
+        bootstrap.bootstrap()
+        bootstrap._onboarding_pool.join()
+        bootstrap._add_node.assert_not_called()
+
+        # member comes online, onboarding fails so the next run tries again
+        member['online'] = True
+        bootstrap.bootstrap()
+        bootstrap._onboarding_pool.join()
         bootstrap.bootstrap()
+        bootstrap._onboarding_pool.join()
+        assert bootstrap._add_node.call_count == 2
 
-        bootstrap._unauthorize_member.assert_called_once_with('member1')
+        # member onboarded and unchanged
+        bootstrap.bootstrap()
+        bootstrap._onboarding_pool.join()
+        assert bootstrap._add_node.call_count == 2
 
     def test_authorize_member(self):
         """
@@ -126,12 +226,34 @@ class TestBootstrapTemplate(ZrobotBaseTest):
             'ssl': True,
             'timeout': 120,
         }
-        patch('js9.j.clients.zos.sal.get_node', MagicMock(return_value='node')).start()
-        node = bootstrap._get_node_sal(ip)
+        get_node = patch('js9.j.clients.zos.sal.get_node', MagicMock(return_value='node')).start()
+        node = bootstrap._get_node_sal('bootstrap_id', ip)
 
-        zero_os.called_once_with(instance='bootstrap', data=data, create=True, die=True)
+        zero_os.assert_called_once_with(instance='bootstrap_id', data=data, create=True, die=True, interactive=False)
+        zero_os.return_value.config.save.assert_not_called()
+        get_node.assert_called_once_with('bootstrap_id', zos_client=zero_os.return_value)
         assert node == 'node'
 
+    def test_get_node_sal_client(self):
+        """
+        Test the node sal uses the client created by _get_node_sal, not one looked up by instance name
+        """
+        client = MagicMock()
+        zero_os = patch('js9.j.clients.zos.get', MagicMock(return_value=client)).start()
+
+        def get_node(instance='main', zos_client=None):
+            # like the SAL, only look the client up by name when none is given
+            node = MagicMock()
+            node.client = zos_client or j.clients.zos.get(instance)
+            return node
+
+        patch('js9.j.clients.zos.sal.get_node', get_node).start()
+        bootstrap = ZeroosBootstrap('bootstrap', data=self.valid_data)
+        node = bootstrap._get_node_sal('bootstrap_id', '127.0.0.1')
+
+        assert node.client is client
+        assert zero_os.call_count == 1
+
     def test_ping_node(self):
         """
         Test ping node
@@ -146,19 +268,75 @@ class TestBootstrapTemplate(ZrobotBaseTest):
         # ensure the loop is working when ping raises an exception
         assert node_sal.client.ping.call_count == 2
 
+    def test_wait_for(self):
+        """
+        Test _wait_for retries the condition with an exponential backoff
+        """
+        sleep = patch('zeroos_bootstrap.sleep', MagicMock()).start()
+        condition = MagicMock(side_effect=[None, Exception, 'ok'])
+
+        assert _wait_for(condition, 60, 'timeout', interval=1, max_interval=10) == 'ok'
+        assert condition.call_count == 3
+        first, second = [call[0][0] for call in sleep.call_args_list]
+        assert 0.5 <= first <= 1
+        assert 1 <= second <= 2
+
+    def test_wait_for_timeout(self):
+        """
+        Test _wait_for raises TimeoutError with the last error once the deadline is reached
+        """
+        patch('zeroos_bootstrap.sleep', MagicMock()).start()
+        condition = MagicMock(side_effect=Exception('connection refused'))
+
+        with pytest.raises(TimeoutError, match='timeout: connection refused'):
+            _wait_for(condition, 0, 'timeout')
+
+    def test_wait_for_caller_timeout(self):
+        """
+        Test _wait_for doesn't retry when a timeout of the caller expires
+        """
+        patch('zeroos_bootstrap.sleep', MagicMock()).start()
+        for error in (gevent.Timeout(), OnboardingTimeoutError('onboarding timeout')):
+            condition = MagicMock(side_effect=error)
+            with pytest.raises(type(error)):
+                _wait_for(condition, 60, 'timeout')
+            assert condition.call_count == 1
+
+    def test_stats(self):
+        """
+        Test stats returns the timing metrics of the onboarding phases
+        """
+        bootstrap = ZeroosBootstrap('bootstrap', data=self.valid_data)
+        with bootstrap._phase('ping'):
+            pass
+        with pytest.raises(RuntimeError):
+            with bootstrap._phase('ping'):
+                raise RuntimeError
+
+        stats = bootstrap.stats()
+        assert stats['ping']['count'] == 2
+        assert stats['ping']['failures'] == 1
+        assert stats['ping']['max'] >= stats['ping']['average']
+
     def test_delete_node(self):
         """
         Test delete node deletes only the node with the right ip
         """
         bootstrap = ZeroosBootstrap('bootstrap', data=self.valid_data)
         bootstrap._unauthorize_member = MagicMock()
+        member3 = {'nodeId': 'id3', 'config': {'authorized': True, 'ipAssignments': ['127.0.0.3']}}
         resp = MagicMock()
-        resp.json = MagicMock(return_value=[self.member, self.member2])
+        resp.json = MagicMock(return_value=[self.member, self.member2, member3])
         bootstrap._zt.client.network.listMembers = MagicMock(return_value=resp)
         bootstrap.delete_node('127.0.0.1')
 
         bootstrap._unauthorize_member.assert_called_with(self.member2)
 
+        # the member is found in the cache
+        bootstrap.delete_node('127.0.0.3')
+        bootstrap._unauthorize_member.assert_called_with(member3)
+        assert bootstrap._zt.client.network.listMembers.call_count == 1
+
     def test_add_node_not_online(self):
         """
         Test add a node that is not online
@@ -247,6 +425,7 @@ class TestBootstrapTemplate(ZrobotBaseTest):
         bootstrap._zt.client.network.updateMember(self.member, self.member['nodeId'], bootstrap.data['zerotierNetID'])
         node_sal.wipedisks.assert_called_once_with()
         erp.schedule_action.assert_called_once_with('register', args={'node_name': node_sal.name})
+        erp.schedule_action.return_value.wait.assert_called_once_with(timeout=REGISTER_TIMEOUT, die=True)
 
     def test_add_node_install_timeout(self):
         """
@@ -1,8 +1,11 @@
+import time
+
 from js9 import j
 from urllib.parse import urlparse
 from zerorobot.template.base import TemplateBase
 
 ZT_TEMPLATE_UID = 'github.com/zero-os/0-templates/zerotier_client/0.0.1'
+ZT_MEMBERS_TTL = 60  # seconds the members of a zerotier network are cached
 
 
 class ZerotierClient(TemplateBase):
@@ -13,6 +16,7 @@ class ZerotierClient(TemplateBase):
     def __init__(self, name=None, guid=None, data=None):
         super().__init__(name=name, guid=guid, data=data)
         self.add_delete_callback(self.uninstall)
+        self._members = {}  # network id -> ({member address: member}, time of the listing)
 
         # client instance already exists
         if self.name in j.clients.zerotier.list():
@@ -35,6 +39,23 @@ class ZerotierClient(TemplateBase):
     def token(self):
         return self.data['token']
 
+    def network_member(self, network_id, address, refresh=False):
+        """
+        Get the member with address of a zerotier network.
+        All the members of the network are listed in one call and cached for ZT_MEMBERS_TTL seconds,
+        the network is listed again before that if the member is not in the cached listing or if refresh is True.
+        This is meant to be called directly by the services of this robot, so they all share the cache
+        :raises ValueError: if the member is not in the network
+        """
+        members, listed = self._members.get(network_id, ({}, 0))
+        if refresh or address not in members or time.time() - listed > ZT_MEMBERS_TTL:
+            network = j.clients.zerotier.get(self.name).network_get(network_id)
+            members = {member.address: member for member in network.members_list()}
+            self._members[network_id] = (members, time.time())
+        if address not in members:
+            raise ValueError('member {} not found in zerotier network {}'.format(address, network_id))
+        return members[address]
+
     def _get_remote_robot(self, url):
         robotname = urlparse(url).netloc
         j.clients.zrobot.get(robotname, {'url': url}, interactive=False)
@@ -54,3 +54,19 @@ class TestZerotierClientTemplate(ZrobotBaseTest):
     def test_token(self):
         service = ZerotierClient(name='zttest', data={'token': 'foo'})
         assert service.token() == 'foo'
+
+    def test_network_member(self):
+        service = ZerotierClient(name='zttest', data={'token': 'foo'})
+        network = self.get.return_value.network_get.return_value
+        network.members_list.return_value = [MagicMock(address='member1'), MagicMock(address='member2')]
+
+        assert service.network_member('network', 'member1').address == 'member1'
+        assert service.network_member('network', 'member2').address == 'member2'
+        network.members_list.assert_called_once_with()
+
+        service.network_member('network', 'member1', refresh=True)
+        assert network.members_list.call_count == 2
+
+        with pytest.raises(ValueError, message='network_member should fail if the member is not in the network'):
+            service.network_member('network', 'member3')
+        assert network.members_list.call_count == 3